@@ -30,13 +30,32 @@ It takes the target script and perform the following steps:
 """
 
 # %%
-from contextlib import contextmanager
+from contextlib import contextmanager, redirect_stderr
 from docutils.core import publish_parts
-from io import StringIO, BytesIO
-from itertools import groupby, dropwhile, accumulate, takewhile
+from html import escape
+from collections import deque
+from io import StringIO, BytesIO, UnsupportedOperation
+from itertools import groupby, dropwhile, accumulate, takewhile, chain
+import ast
+import docutils
+import filecmp
+import hashlib
+import importlib
+import inspect
+import json
+import marshal
 import os
+import pickle
+import re
+import shlex
+import shutil
 import sys
+import tempfile
+import time
 import tokenize
+import traceback
+import types
+import weakref
 
 """
 Pylab Cage
@@ -75,110 +94,200 @@ class OutputCage(object):
 
     This behavior is not completely true to the matplotlib one.
     """
-    def __init__(self):
-        """creates the object, no parameters are required.
+    # the cage capturing the output of the block being executed
+    active = None
+
+    def __init__(self, sink=None, close_figures=False, output_lines=None):
+        """creates the object, the optional parameters are the
+        :code:`FigureSink` where the figures are written as they are shown,
+        whether to close the figures once they have been captured, and
+        the number of lines kept at the beginning and at the end of the
+        output of each block (see :code:`BoundedOutput`).
 
         For a single compilation run only a single object is required.
         """
-        self.fig_index = set()
+        self.sink = sink
+        self.close_figures = close_figures
+        self.output_lines = output_lines
+        self.block_index = 0
+        # time spent rendering the figures of the current block
+        self.encode_time = 0.0
+        # the figures already shown, without keeping them alive
+        self.fig_index = weakref.WeakSet()
         self.last_drawn = []
         self.old_stdout = sys.__dict__['stdout']
         self.old_stderr = sys.__dict__['stderr']
-        self.my_stdout = StringIO()
-        self.my_stdout_old = StringIO()
-        self.my_stderr = StringIO()
-        self.my_stderr_old = StringIO()
+        if output_lines is None:
+            self.my_stdout = StringIO()
+            self.my_stderr = StringIO()
+        else:
+            self.my_stdout = BoundedOutput(self, 'stdout', output_lines)
+            self.my_stderr = BoundedOutput(self, 'stderr', output_lines)
+        self.in_session = False
+        self.block_boundary = _BlockBoundary(self)
+        # started by the first block using top-level await
+        self.event_loop = None
+        self.loop_thread = None
 
     # the output cage: it captures stdout, stderr and pylab figures temporarely
-    @contextmanager
     def redifine_output(self, glob):
         """intercept the output to stdout, stderr and the pylab shows.
 
         Should be used as a context manager, and will give out the
         StringIO that replaces sys.stdout and sis.stderr.
         Pylab shows function results are stored internally to be obtained
-        with the :code:`OutputCage.get_figures` function
-        """
-        # FIXME the problem is that when it does load the stdout
-        # and stderr it will create two new StringIO that then
-        # are lost in the following call! I have to make them
-        # persistent and retrieve the results while it goes
-
-        sys.__dict__['stdout'] = self.my_stdout
-        sys.__dict__['stderr'] = self.my_stderr
-
-        pylab_name = "__pylab__literate__"
-        exec("import pylab as {}\n".format(pylab_name), glob)
-        old_pylab_show = glob[pylab_name].show
-        old_figure_show = glob[pylab_name].Figure.show
-        old_pyplot_show = glob[pylab_name].matplotlib.pyplot.show
+        with the :code:`OutputCage.get_figures` function.
+        The show functions are replaced once, when matplotlib is imported
+        while the output is intercepted (see :code:`_MatplotlibFinder`),
+        and send the figures to the active cage.
 
-        replaced = {}
-        glob[pylab_name].show = self.pylab_show
+        Inside a :code:`OutputCage.session` the output is already
+        intercepted, and only the beginning of the block is marked.
+        """
+        if self.in_session:
+            return self.block_boundary
+        return self._intercept_output()
 
-        def fig_show(fig, *args, **kwargs):
-            return self.figure_show(fig, *args, **kwargs)
-        glob[pylab_name].Figure.show = fig_show
+    @contextmanager
+    def session(self):
+        """intercept the output for a whole run, instead of doing it
+        again for each block executed inside the context.
 
-        glob[pylab_name].matplotlib.pyplot.show = self.pylab_show
+        the output printed between the blocks is captured as well, and
+        goes to the following block.
+        """
+        with self._intercept_output():
+            self.in_session = True
+            try:
+                yield self
+            finally:
+                self.in_session = False
 
+    @contextmanager
+    def _intercept_output(self):
+        sys.__dict__['stdout'] = self.my_stdout
+        sys.__dict__['stderr'] = self.my_stderr
+        previous_cage = OutputCage.active
+        OutputCage.active = self
         try:
-            yield
+            # redirect the matplotlib to the written version, when the
+            # script imports it
+            with _matplotlib_hook():
+                yield
         finally:
             sys.__dict__['stdout'] = self.old_stdout
             sys.__dict__['stderr'] = self.old_stderr
-            glob[pylab_name].show = old_pylab_show
-            glob[pylab_name].Figure.show = old_figure_show
-            glob[pylab_name].matplotlib.pyplot.show = old_pyplot_show
-            for name, value in replaced.items():
-                glob[name] = value
+            OutputCage.active = previous_cage
+
+    def _pop_output(self, stream):
+        """return the content of the stream and empty it
+
+        the same stream object is kept for the whole run, so references
+        to sys.stdout taken by the script keep working, and the cost of
+        the capture only depends on the output of the last block.
+        """
+        if isinstance(stream, BoundedOutput):
+            return stream.pop()
+        content = stream.getvalue()
+        if content:
+            stream.seek(0)
+            stream.truncate(0)
+        return content
 
     def get_stdout(self):
-        str_old = self.my_stdout_old.getvalue()
-        str_new = self.my_stdout.getvalue()
-        diff_str = str_new[len(str_old):]
-        self.my_stdout_old = StringIO(str_new)
-        return StringIO(diff_str)
+        return StringIO(self._pop_output(self.my_stdout))
 
     def get_stderr(self):
-        str_old = self.my_stderr_old.getvalue()
-        str_new = self.my_stderr.getvalue()
-        diff_str = str_new[len(str_old):]
-        self.my_stderr_old = StringIO(str_new)
-        return StringIO(diff_str)
+        return StringIO(self._pop_output(self.my_stderr))
 
     def pylab_show(self, *args, **kwargs):
         """this is the replacement of the :code:`pylab.show` function call
 
         it will get the lastet created figures that are not already shown
         and create binary objects out of them. the results is put in
-        a list of BytesIO objects, where each BytesIO is the png (for now)
+        a list of BytesIO objects, where each BytesIO is the png
         representation of the image.
-
-        .. warning::
-
-            This function should be personalized to get options about format
-            and resolution, but that is not yet provided
+        If the cage has a figure sink, the images are written to disk
+        right away, in the format and resolution of the sink, and only
+        their file names are kept.
+        The open figures are listed without making them active, so the
+        current figure of the script does not change.
         """
-        import pylab
-        self.last_drawn = []
-        figs = list(map(pylab.figure, pylab.get_fignums()))
+        from matplotlib._pylab_helpers import Gcf
+        figs = [manager.canvas.figure for num, manager in
+                sorted(Gcf.figs.items())]
         new_figures = [fig for fig in figs if fig not in self.fig_index]
-        self.fig_index.update(set(figs))
-        # fig = pylab.gcf()
         for fig in new_figures:
-            file_descriptor = BytesIO()
-            fig.savefig(file_descriptor, format='png')
-            self.last_drawn.append(file_descriptor)
+            self.fig_index.add(fig)
+            self.store_figure(fig)
 
     def figure_show(self, figure, *args, **kwargs):
         """this figure is called when a single figure requires a show
 
         it will show the figure even if it has been show already
         """
-        file_descriptor = BytesIO()
-        figure.savefig(file_descriptor, format='png')
-        self.last_drawn.append(file_descriptor)
+        self.store_figure(figure)
+
+    def store_figure(self, figure):
+        """render the figure and add it to the figures of the block"""
+        start = time.perf_counter()
+        if self.sink is not None:
+            f_name = self.sink.write(figure, self.block_index)
+            self.last_drawn.append(f_name)
+        else:
+            self.last_drawn.append(BytesIO(_render_figure(figure)))
+        self.encode_time += time.perf_counter() - start
+        if self.close_figures:
+            # the figure object keeps working, but pyplot forgets it
+            from matplotlib import pyplot
+            pyplot.close(figure)
+
+    def run_coroutine(self, coroutine):
+        """run the coroutine of a block on the event loop of the run,
+        starting it if needed, and wait for its result
+        """
+        import asyncio
+        import threading
+        if self.event_loop is None:
+            self.event_loop = asyncio.new_event_loop()
+            self.loop_thread = threading.Thread(
+                target=self.event_loop.run_forever, daemon=True,
+                name='literate event loop')
+            self.loop_thread.start()
+        future = asyncio.run_coroutine_threadsafe(_interruptible(coroutine),
+                                                  self.event_loop)
+        result, interruption = future.result()
+        if interruption is not None:
+            raise interruption
+        return result
+
+    def drain_tasks(self):
+        """wait for the tasks started by the blocks and not awaited yet
+
+        the exceptions they raised are printed on the standard error
+        and returned.
+        """
+        if self.event_loop is None:
+            return []
+        errors = self.run_coroutine(_drain_tasks())
+        for error in errors:
+            print("a task of the script raised {!r}".format(error),
+                  file=sys.stderr)
+        return errors
+
+    def close_event_loop(self, timeout=1.0):
+        """stop the event loop, abandoning the tasks still pending
+
+        if a block is still running on it (when the run has been
+        aborted) the loop is left to its daemon thread after the timeout.
+        """
+        if self.event_loop is None:
+            return
+        self.event_loop.call_soon_threadsafe(self.event_loop.stop)
+        self.loop_thread.join(timeout)
+        if not self.loop_thread.is_alive():
+            self.event_loop.close()
+        self.event_loop = self.loop_thread = None
 
     def get_figures(self):
         """this pop the list of all the figures created when pylab.show
@@ -188,7 +297,9 @@ class OutputCage(object):
         self.last_drawn = []
         return res
 
-    def generate_globals(self):
+    def generate_globals(self, argv=None):
+        if argv is None:
+            argv = sys.argv
         glob = {}
         # correctly handles the __main__ execution
         exec('__name__ = "__main__"', glob)
@@ -198,12 +309,436 @@ class OutputCage(object):
         exec('def __raises(i):\n\traise KeyboardInterrupt(str(i))')
         exec('sys.exit = __raises')
         exec('del __raises')
-        # redirect the matplotlib to the written version
-        exec("import matplotlib as __mpl__literate__\n", glob)
-        exec("__mpl__literate__.use('Agg')\n", glob)
-        exec("del __mpl__literate__", glob)
         return glob
 
+
+class _BlockBoundary(object):
+    """the start of a block inside a session of an :code:`OutputCage`
+
+    a single object is reused for all the blocks, so marking a boundary
+    only costs setting the streams again, in case the previous block
+    replaced them.
+    """
+    def __init__(self, cage):
+        self.cage = cage
+
+    def __enter__(self):
+        sys.__dict__['stdout'] = self.cage.my_stdout
+        sys.__dict__['stderr'] = self.cage.my_stderr
+        OutputCage.active = self.cage
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class BoundedOutput(object):
+    """a stream capturing the output of the blocks in bounded memory
+
+    only the first and the last lines (as many as given) of the output of
+    a block are kept. When the output is longer the lines in between are
+    replaced by a marker, and the whole output is written as it is printed
+    to a text file of the output directory of the cage (if it has a
+    :code:`FigureSink`), named after the block and the stream. The file is
+    written under a temporary name, and replaces the one of the previous
+    compilation only if its content changed, counting it in the
+    write_report of the sink.
+
+    After :code:`BoundedOutput.pop` the bytes written by the block and the
+    name of the file with all of them (or None) are in popped_bytes and
+    popped_file.
+    """
+    def __init__(self, cage, name, lines):
+        self.cage = cage
+        self.name = name
+        self.lines = lines
+        self.popped_bytes = 0
+        self.popped_file = None
+        self._reset()
+
+    def _reset(self):
+        self.head = []
+        self.tail = deque(maxlen=self.lines)
+        self.partial = ''
+        self.count = 0
+        self.size = 0
+        self.file = None
+        self.file_name = None
+        self.temp_path = None
+        # the writes are processed in chunks, as print writes many times
+        self.pending = []
+        self.pending_size = 0
+
+    # a plain object, as the methods of io.TextIOBase slow down print
+    encoding = None
+    closed = False
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        raise UnsupportedOperation("the output is captured by literate")
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size > 65536:
+            self._process_pending()
+        return len(text)
+
+    def flush(self):
+        self._process_pending()
+        if self.file is not None:
+            self.file.flush()
+
+    def _process_pending(self):
+        text = "".join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        self.size += len(text.encode('utf8', 'replace'))
+        newlines = text.count('\n')
+        if (self.file is None and self.cage.sink is not None and
+                self.count + newlines > 2 * self.lines):
+            self._spill()
+        if self.file is not None:
+            self.file.write(text)
+        if newlines:
+            lines = (self.partial + text).split('\n')
+            self.partial = lines.pop()
+            free = self.lines - len(self.head)
+            self.head.extend(lines[:free])
+            self.tail.extend(lines[free:])
+            self.count += len(lines)
+        else:
+            self.partial += text
+
+    def _spill(self):
+        """start writing to the file, with the lines printed until now
+
+        as they exceed the limit only now, none of them has been dropped
+        """
+        self.file_name = "output_{}_{}.txt".format(self.cage.block_index,
+                                                   self.name)
+        f_path = os.path.join(self.cage.sink.output_dir, self.file_name)
+        self.temp_path = "{}.{}.tmp".format(f_path, os.getpid())
+        self.file = open(self.temp_path, 'w', encoding='utf8',
+                         errors='replace')
+        for line in chain(self.head, self.tail):
+            self.file.write(line + '\n')
+        self.file.write(self.partial)
+
+    def pop(self):
+        """the output of the block, with the middle lines elided"""
+        self._process_pending()
+        lines = self.head + list(self.tail)
+        omitted = self.count - len(lines)
+        if omitted:
+            marker = "[... {} lines omitted ...]".format(omitted)
+            if self.file_name is not None:
+                marker = "[... {} lines omitted, the whole output is in {} " \
+                         "...]".format(omitted, self.file_name)
+            lines.insert(len(self.head), marker)
+        content = "".join(line + '\n' for line in lines) + self.partial
+        if self.file is not None:
+            self.file.close()
+            f_path = os.path.join(os.path.dirname(self.temp_path),
+                                  self.file_name)
+            _replace_if_changed(self.temp_path, f_path,
+                                self.cage.sink.write_report)
+        self.popped_bytes = self.size
+        self.popped_file = self.file_name
+        self._reset()
+        return content
+
+
+def _popped_extent(stream, content):
+    """the bytes written to the stream by the last block, and the name of
+    the file where they have been written in full
+    """
+    if isinstance(stream, BoundedOutput):
+        return stream.popped_bytes, stream.popped_file
+    return len(content.encode('utf8', 'replace')), None
+
+
+# %%
+"""
+Matplotlib is imported only if the script uses it, as importing it (and
+numpy) takes a large part of the time needed to compile a short report.
+An import hook waits for the matplotlib modules to be imported to select
+the Agg backend and replace the show functions with ones that send the
+figures to the active :code:`OutputCage`, or behave as the original ones
+outside of the execution of a block.
+"""
+
+
+def _replace_show(owner, cage_show):
+    """replace owner.show with a function calling cage_show on the
+    active cage, if any"""
+    original = owner.show
+    if getattr(original, '_literate_show', False):
+        return
+
+    # a plain function, as matplotlib sets attributes on pyplot.show
+    def show(*args, **kwargs):
+        cage = OutputCage.active
+        if cage is None:
+            return original(*args, **kwargs)
+        return cage_show(cage, *args, **kwargs)
+    show._literate_show = True
+    owner.show = show
+
+
+def _patch_matplotlib(name, module):
+    """prepare a matplotlib module, just imported, for the output cage"""
+    if name == 'matplotlib':
+        module.use('Agg')
+    elif name == 'matplotlib.figure':
+        _replace_show(module.Figure, OutputCage.figure_show)
+    else:
+        _replace_show(module, OutputCage.pylab_show)
+
+
+class _MatplotlibFinder(object):
+    """meta path finder patching the matplotlib modules once imported"""
+    names = ('matplotlib', 'matplotlib.figure', 'matplotlib.pyplot', 'pylab')
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in self.names:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        exec_module = spec.loader.exec_module
+
+        def patching_exec_module(module):
+            exec_module(module)
+            _patch_matplotlib(fullname, module)
+        spec.loader.exec_module = patching_exec_module
+        return spec
+
+
+@contextmanager
+def _matplotlib_hook():
+    """patch the matplotlib modules already imported, and the other ones
+    as soon as they are imported inside the context
+
+    the finder is removed when the outermost context exits, so the
+    programs importing literate as a library keep their own backend.
+    """
+    if any(isinstance(finder, _MatplotlibFinder)
+           for finder in sys.meta_path):
+        yield
+        return
+    for name in _MatplotlibFinder.names:
+        if name in sys.modules:
+            _patch_matplotlib(name, sys.modules[name])
+    finder = _MatplotlibFinder()
+    sys.meta_path.insert(0, finder)
+    try:
+        yield
+    finally:
+        if finder in sys.meta_path:
+            sys.meta_path.remove(finder)
+
+
+# %%
+class FigureSink(object):
+    """writes the figures to the output directory as soon as they are shown
+
+    In this way only one figure at the time is kept in memory, and the
+    images already produced survive a failure of the script.
+    The images are named after the hash of their content, so identical
+    images are stored once and an image already in the directory is not
+    written again. The format (png, svg, webp...), the resolution and the
+    optimization level are given by fmt, dpi and optimize
+    (see :code:`_render_figure`).
+
+    If a :code:`FigureEncoder` is given the figures are rendered by its
+    workers. Their names are known only once they are rendered, so a
+    provisional name is returned, replaced in the results of the blocks
+    by :code:`FigureSink.resolve`.
+    """
+    def __init__(self, output_dir, encoder=None, fmt='png', dpi=None,
+                 optimize=None):
+        self.output_dir = output_dir
+        self.encoder = encoder
+        self.options = {'fmt': fmt, 'dpi': dpi, 'optimize': optimize}
+        # the provisional names of the figures sent to the encoder
+        self.pending = {}
+        # the files written while executing the blocks, counted as by
+        # _write_if_changed
+        self.write_report = {}
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+    def write(self, figure, block_index):
+        """save the figure shown by the block, returns the name of the file
+        """
+        if self.encoder is not None:
+            future = self.encoder.submit(figure, self.output_dir,
+                                         self.options)
+            if future is not None:
+                f_name = "pending_figure_{}_{}".format(block_index,
+                                                       len(self.pending))
+                self.pending[f_name] = future
+                return f_name
+        data = _render_figure(figure, **self.options)
+        return _store_figure(self.output_dir, data, self.options['fmt'])
+
+    def resolve(self, results):
+        """replace the provisional names of the figures in the results of a
+        block, waiting for them to be rendered. returns True if any name
+        has been replaced.
+        """
+        figures = results.get("generated figures") or []
+        if not any(f_name in self.pending for f_name in figures
+                   if isinstance(f_name, str)):
+            return False
+        results["generated figures"] = [
+            self.pending[f_name].result()
+            if isinstance(f_name, str) and f_name in self.pending else f_name
+            for f_name in figures]
+        return True
+
+    def join(self):
+        """wait for all the figures to be written"""
+        if self.encoder is not None:
+            self.encoder.join()
+
+    def close(self):
+        if self.encoder is not None:
+            self.encoder.shutdown()
+
+
+def _render_figure(figure, fmt='png', dpi=None, optimize=None):
+    """the bytes of the image of the figure in the given format
+
+    dpi defaults to the one of the figure. optimize is the compression
+    effort: the zlib level (0-9) for png and the method (0-6) for webp.
+    The metadata changing at each rendering (the date and the random ids
+    of the svg) are fixed, so the same figure gives the same bytes.
+    """
+    import matplotlib
+    options = {'format': fmt}
+    if dpi is not None:
+        options['dpi'] = dpi
+    if fmt == 'svg':
+        options['metadata'] = {'Date': None}
+    if optimize is not None:
+        if fmt == 'png':
+            options['pil_kwargs'] = {'compress_level': optimize}
+        elif fmt == 'webp':
+            options['pil_kwargs'] = {'method': min(optimize, 6)}
+    file_descriptor = BytesIO()
+    with matplotlib.rc_context({'svg.hashsalt': 'literate'}):
+        figure.savefig(file_descriptor, **options)
+    return file_descriptor.getvalue()
+
+
+def _figure_name(data, fmt='png'):
+    """the name of the image file, after the hash of its content"""
+    return "figure_{}.{}".format(hashlib.sha256(data).hexdigest()[:20], fmt)
+
+
+def _store_figure(output_dir, data, fmt='png'):
+    """write the image in the directory unless already there, returns
+    the name of the file
+    """
+    f_name = _figure_name(data, fmt)
+    f_path = os.path.join(output_dir, f_name)
+    if not os.path.exists(f_path):
+        # other processes could be writing the same image
+        temp_path = "{}.{}.tmp".format(f_path, os.getpid())
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, f_path)
+    return f_name
+
+
+# %%
+def _init_encoder_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _encode_figure(payload, output_dir, options):
+    figure = pickle.loads(payload)
+    try:
+        data = _render_figure(figure, **options)
+    finally:
+        # the unpickled figures are registered by pyplot, as if created
+        # in the worker, and would stay open for the whole run
+        pyplot = sys.modules.get('matplotlib.pyplot')
+        if pyplot is not None:
+            pyplot.close(figure)
+    return _store_figure(output_dir, data, options['fmt'])
+
+
+class FigureEncoder(object):
+    """renders the figures in a pool of worker processes
+
+    The figures are pickled when shown, so the script can keep modifying
+    them, and the rendering happens while the following blocks are
+    executed. At most two figures for each worker are waiting at any time,
+    to keep the memory bounded.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+        self.pending = []
+
+    def submit(self, figure, output_dir, options):
+        """send the figure to the workers, to be rendered with the options
+        of :code:`_render_figure` and stored in the output directory.
+        returns the future of the name of the file, or None if the figure
+        can't be pickled and should be rendered directly
+        """
+        try:
+            payload = pickle.dumps(figure, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return None
+        if self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            context = multiprocessing.get_context('spawn')
+            self.executor = ProcessPoolExecutor(
+                self.workers, mp_context=context,
+                initializer=_init_encoder_worker)
+        self.pending = [future for future in self.pending
+                        if not future.done() or future.exception()]
+        if len(self.pending) >= 2 * self.workers:
+            self.pending.pop(0).result()
+        future = self.executor.submit(_encode_figure, payload, output_dir,
+                                      options)
+        self.pending.append(future)
+        return future
+
+    def join(self):
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def shutdown(self):
+        try:
+            self.join()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
 # %%
 """
 Helper Functions
@@ -331,6 +866,132 @@ def _generate_logical_lines(readline):
     return lines
 
 
+# %%
+_CELL_MARKER = re.compile(r'#\s*%%')
+
+
+def _starts_cell(group):
+    """True if the group begins with a :code:`# %%` cell marker comment"""
+    for token in group.tokens:
+        if token.type == tokenize.COMMENT:
+            if _CELL_MARKER.match(token.string):
+                return True
+        elif token.type not in _IGNORABLE_TOKENS:
+            return False
+    return False
+
+
+# %%
+def _untokenize_group(tokens):
+    """rebuild the source of a list of tokens that are not
+    at the beginning of the file.
+
+    used only for the groups created directly from the tokens,
+    as the ones coming from the source keep the original text.
+    """
+    # a group following an indented block starts with the DEDENT tokens
+    # closing it, that untokenize can't handle without the matching INDENT
+    depth = 0
+    balanced_tokens = []
+    for token in tokens:
+        if token.type == tokenize.INDENT:
+            depth += 1
+        elif token.type == tokenize.DEDENT:
+            if not depth:
+                continue
+            depth -= 1
+        balanced_tokens.append(token)
+    is_whiteline = lambda s: s == '\\'
+    groups_lines = tokenize.untokenize(balanced_tokens)
+    # remove the superfluous lines at the beginning due
+    # to how untokenize work join them together again
+    groups_lines = dropwhile(is_whiteline, groups_lines.split('\n'))
+    return "\n".join(groups_lines)
+
+
+# %%
+def _peak_memory():
+    """the peak resident memory of the process in bytes, None if unknown"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# %%
+"""
+Top-level Await
+===============
+
+The blocks are compiled allowing :code:`await` outside of functions, and
+the ones using it are executed on an event loop that lives for the whole
+run, so the tasks created by a block keep running while the following
+blocks are executed. The loop runs in its own thread: the tasks can
+progress (for example waiting for a download) even during the blocks that
+don't await anything.
+Only the blocks with a top-level :code:`await`, :code:`async for` or
+:code:`async with` are executed on the loop, all the others are executed
+on the main thread as usual (so they can call :code:`asyncio.run`, be
+profiled or install signal handlers). The tasks should then be created
+by a block that awaits something, even just :code:`asyncio.sleep(0)`.
+
+At the end of the run the tasks still pending are awaited before writing
+the report.
+"""
+
+def _compile_block(source):
+    return compile(source, '<string>', 'exec',
+                   flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+
+
+def _uses_event_loop(source, code=None):
+    """if the code has to be executed on the event loop of the run"""
+    if code is None:
+        try:
+            code = _compile_block(source)
+        except SyntaxError:
+            return False
+    return bool(code.co_flags & inspect.CO_COROUTINE)
+
+
+def _execute_code(source, global_dict):
+    """execute the code of a block, on the event loop of the active cage if
+    it uses top-level await
+    """
+    code = _compile_block(source)
+    if _uses_event_loop(source, code):
+        OutputCage.active.run_coroutine(eval(code, global_dict))
+    else:
+        exec(code, global_dict)
+
+
+async def _interruptible(coroutine):
+    """the interruptions of the script are returned instead of stopping
+    the thread of the event loop
+    """
+    try:
+        return await coroutine, None
+    except (KeyboardInterrupt, SystemExit) as e:
+        return None, e
+
+
+async def _drain_tasks():
+    """await all the pending tasks, returns the exceptions they raised"""
+    import asyncio
+    errors = []
+    while True:
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        if not tasks:
+            return errors
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        errors.extend(outcome for outcome in outcomes
+                      if isinstance(outcome, Exception) and
+                      not isinstance(outcome, asyncio.CancelledError))
+
+
 # %%
 """
 The CodeGroup Class
@@ -338,6 +999,18 @@ The CodeGroup Class
 """
 
 
+def _indent_lines(text, indent):
+    """the text with each line indented, ending with a newline"""
+    return "".join(indent + line + '\n' for line in text.split('\n'))
+
+
+def _output_file_rst(f_name, indent):
+    """the link to the file with the whole output of a block"""
+    f_link = os.path.join(os.path.curdir, f_name)
+    return "\n{}The whole output is in `{} <{}>`_\n\n".format(indent, f_name,
+                                                              f_link)
+
+
 class CodeGroup(object):
     """this is the main class, responsible for holding the code
     and executing it
@@ -352,30 +1025,54 @@ class CodeGroup(object):
         self.following = None
         if self.previous is not None:
             self.previous.following = self
+            self.index = self.previous.index + 1
+        else:
+            self.index = 0
         self.results = {}
         self.globals = None
+        self.cache_key = None
+        # the top functions of the last execution, see BlockProfiler
+        self.profile = None
+        # the memory allocated by the last execution, see MemoryTracer
+        self.memory = None
+        # True if the results are not coming from an execution of the block
+        self.reused = False
+        # first and last physical row of the block in the source, known
+        # only for the groups created by iterate_groups_from_source
+        self.line_range = None
+        # these are computed at most once, on the first access, unless
+        # already filled in by iterate_groups_from_source
+        self._lines = None
+        self._line_sources = None
+        self._source = None
+        self._docstring = None
 
     def get_index(self):
-        if self.previous is None:
-            return 0
-        else:
-            return 1+self.previous.get_index()
+        return self.index
 
     @property
     def lines(self):
-        return _generate_logical_lines(self.tokens)
+        if self._lines is None:
+            self._lines = _generate_logical_lines(self.tokens)
+        return self._lines
+
+    def _line_source(self, idx):
+        """the source code of the idx-th logical line of the group"""
+        if self._line_sources is None:
+            self._line_sources = [str(self.__class__(line))
+                                  for line in self.lines]
+        return self._line_sources[idx]
 
     def extract_docstrings(self):
-        doc_lines = [bool(_is_docstring(line)) for line in self.lines]
-        indexes = range(len(self.lines))
+        lines = self.lines
+        doc_lines = [_is_docstring(line) for line in lines]
         docstrings = []
-        for idx, is_doc, line in zip(indexes, doc_lines, self.lines):
-            if is_doc and idx > 0 and not doc_lines[idx-1]:
-                prev_line = self.lines[idx-1]
+        for idx, line_str in enumerate(doc_lines):
+            if line_str and idx > 0 and not doc_lines[idx-1]:
+                prev_line = lines[idx-1]
                 if not _is_block_start(prev_line):
                     continue
-                line_str_pre = str(self.__class__(prev_line))
-                line_str = eval(str(self.__class__(line)))
+                line_str_pre = self._line_source(idx-1)
                 docstring_text = ".. note::\n\n\t.. code:: python\n\n"
 
                 splitlines = line_str_pre.splitlines()
@@ -392,24 +1089,37 @@ class CodeGroup(object):
         return docstrings
 
     def __str__(self):
-        is_whiteline = lambda s: s == '\\'
-        groups_lines = tokenize.untokenize(self.tokens)
-        # remove the superfluous lines at the beginning due
-        # to how untokenize work join them together again
-        groups_lines = dropwhile(is_whiteline, groups_lines.split('\n'))
-        groups_lines = list(groups_lines)
-        # this final bit is required to assure that the combination
-        # of the various groups reconstruct the original source code
-        if groups_lines[0] == '\n':
-            groups_lines = groups_lines[1:]
-        return "\n".join(groups_lines)
-
-    def execute(self, global_dict, pylab_show_cage):
+        if self._source is None:
+            self._source = _untokenize_group(self.tokens)
+        return self._source
+
+    def execute(self, global_dict, pylab_show_cage, cache=None,
+                use_cached=True, profiler=None):
         """execute the block in the given gloabal dict under the given cage
+
+        if a :code:`ResultCache` is given and the block has a cache key,
+        the stored results are returned without running the code (unless
+        use_cached is False) and freshly computed results are stored.
+        If a profiler is given (a :code:`BlockProfiler` or a
+        :code:`MemoryTracer`) the code is executed by it.
         """
         assert type(global_dict) == dict, "the globals should be a base dict!"
         self.globals = global_dict
+        self.profile = None
+        self.memory = None
+        if cache is not None and self.cache_key is not None:
+            cached = cache.get(self.cache_key) if use_cached else None
+            if cached is not None:
+                self.results = cached
+                self.reused = True
+                return self.results
+        self.reused = False
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+        start_memory = _peak_memory()
         myshow = pylab_show_cage
+        myshow.block_index = self.get_index()
+        myshow.encode_time = 0.0
         do_interrupt = False
         # this is necessary to allow me to keep writing even in the output cage
         with myshow.redifine_output(global_dict):
@@ -418,7 +1128,10 @@ class CodeGroup(object):
             # and save them as results, but I can't see any way out of this
             exceptions = None
             try:
-                exec(str(self), global_dict)
+                if profiler is None:
+                    _execute_code(str(self), global_dict)
+                else:
+                    profiler.run(self, global_dict)
             except (KeyboardInterrupt, SystemExit):
                 do_interrupt = True
             except Exception as e:
@@ -427,11 +1140,28 @@ class CodeGroup(object):
                 s = s.format(self.get_index(), str(self))
                 raise type(e)(s + repr(e)).with_traceback(sys.exc_info()[2])
             # take the output results out of the output cage
-            out = myshow.get_stdout().getvalue()
-            err = myshow.get_stderr().getvalue()
+            out = myshow._pop_output(myshow.my_stdout)
+            err = myshow._pop_output(myshow.my_stderr)
+            out_bytes, out_file = _popped_extent(myshow.my_stdout, out)
+            err_bytes, err_file = _popped_extent(myshow.my_stderr, err)
+            output_files = {}
+            if out_file is not None:
+                output_files["standard output"] = out_file
+            if err_file is not None:
+                output_files["standard error"] = err_file
 
             figures = myshow.get_figures()
 
+            usage = {'wall time': time.perf_counter() - start_time,
+                     'cpu time': time.process_time() - start_cpu,
+                     'peak memory increase': None,
+                     'figure encode time': myshow.encode_time,
+                     'standard output bytes': out_bytes,
+                     'standard error bytes': err_bytes,
+                     }
+            if start_memory is not None:
+                usage['peak memory increase'] = _peak_memory() - start_memory
+
             # output to normal lines the global keys, just a debug thing
             # create the result block with the code and all the results
             # and append it to the total array of results
@@ -443,14 +1173,18 @@ class CodeGroup(object):
                             "generated figures": figures,
                             "exceptions generated": exceptions,
                             "interrupted": do_interrupt,
+                            "output files": output_files,
+                            "resource usage": usage,
                             }
+        if cache is not None and self.cache_key is not None:
+            cache.put(self.cache_key, self.results)
         return self.results
 
     def has_results(self):
         if not self.results:
             return False
         for key, value in self.results.items():
-            if value:
+            if value and key != "resource usage":
                 return True
         return False
 
@@ -460,7 +1194,9 @@ class CodeGroup(object):
         return the content or an empty string if invalid.
         if the string is empty, it will not consider it as valid
         """
-        return _is_docstring(self.tokens)
+        if self._docstring is None:
+            self._docstring = _is_docstring(self.tokens)
+        return self._docstring
 
     def compile(self, output_dir):
         """compile the executed code into rst
@@ -479,11 +1215,15 @@ class CodeGroup(object):
         if self.results:  # self.has_results():
             compiled_rst += '\n\n'
 
+        output_files = self.results.get("output files") or {}
         if "standard error" in self.results:
             if self.results["standard error"]:
                 compiled_rst += ".. warning::\n\n    ::\n\n"
-                for line in self.results["standard error"].split('\n'):
-                    compiled_rst += 2*"    "+line+'\n'
+                compiled_rst += _indent_lines(self.results["standard error"],
+                                              2*"    ")
+                if "standard error" in output_files:
+                    compiled_rst += _output_file_rst(
+                        output_files["standard error"], "    ")
         if "exceptions generated" in self.results:
             if self.results["exceptions generated"]:
                 compiled_rst += ".. warning:: Exception Raised\n\n    ::\n\n"
@@ -493,58 +1233,1183 @@ class CodeGroup(object):
         if "standard output" in self.results:
             if self.results["standard output"]:
                 compiled_rst += "::\n\n"
-                for line in self.results["standard output"].split('\n'):
-                    compiled_rst += "    "+line+'\n'
+                compiled_rst += _indent_lines(self.results["standard output"],
+                                              "    ")
+                if "standard output" in output_files:
+                    compiled_rst += _output_file_rst(
+                        output_files["standard output"], "")
+        figure_dict = {}
         if "generated figures" in self.results:
             figures = self.results["generated figures"]
-            figure_dict = {}
-            for fig_idx, figure_bytes in enumerate(figures):
-                index = self.get_index()
-                f_name = "figure_{}_{}.png".format(index, fig_idx)
-                figure_dict[f_name] = figure_bytes
+            for figure_bytes in figures:
+                if isinstance(figure_bytes, str):
+                    # already written by the figure sink
+                    f_name = figure_bytes
+                else:
+                    f_name = _figure_name(figure_bytes.getvalue())
+                    figure_dict[f_name] = figure_bytes
                 # f_dir = os.path.join(output_dir, f_name)
                 # with open(f_dir, 'wb') as file:
                 #     file.write(figure_bytes.getvalue())
                 f_link = os.path.join(os.path.curdir, f_name)
                 compiled_rst += ".. image:: "+str(f_link)+"\n\n"
+        if self.profile is not None:
+            compiled_rst += _profile_rst(self.profile, self.get_index())
+        if self.memory is not None:
+            compiled_rst += _memory_rst(self.memory)
 
         return (compiled_rst, figure_dict)
 
     @classmethod
     def iterate_groups_from_source(cls, readline):
-        lines = _generate_logical_lines(readline)
+        """split the source in groups, reading and tokenizing it only once
+
+        the lines read are kept, so that each group gets the source text
+        of its own lines instead of rebuilding it from the tokens
+        """
+        source_lines = []
+
+        def recording_readline():
+            line = readline()
+            source_lines.append(line)
+            return line
+
+        lines = _generate_logical_lines(recording_readline)
+        # the logical lines cover the physical ones without holes,
+        # each ending on the row of its NEWLINE token
+        line_rows = []
+        line_sources = []
+        first_row = 1
+        for line in lines:
+            last_row = line[-1].start[0]
+            line_rows.append((first_row, last_row))
+            line_sources.append("".join(source_lines[first_row-1:last_row]))
+            first_row = last_row + 1
         # for each line, determins its level of variation of indentation
         var_indent_lev = map(_evaluate_indent_variation, lines)
         # accumulate to obtain the total one
         indent_levels = accumulate(var_indent_lev)
         # this checks is the line starts with a decorator
         is_decorator = lambda lg: lg[-1].line.strip().startswith('@')
-        last_group = []
+
+        def make_group(first, last, previous):
+            tokens = [token for line in lines[first:last] for token in line]
+            group = cls(tokens, previous)
+            group._lines = lines[first:last]
+            group._line_sources = line_sources[first:last]
+            group._source = "".join(group._line_sources)
+            group._docstring = _is_docstring(group.tokens)
+            group.line_range = (line_rows[first][0], line_rows[last-1][1])
+            return group
+
+        # the group being built goes from the logical line first_line
+        # to the current one
+        first_line = 0
         last_created_group = None
-        for line, indent_level in zip(lines, indent_levels):
+        for idx, (line, indent_level) in enumerate(zip(lines, indent_levels)):
             # if is a flat line, either start or if it is a decorator
             # store it for later
-            if indent_level == 0:
-                # have to check for decorators
-                if (not last_group) or is_decorator(last_group):
-                    last_group.extend(line)
-                # now I check if the block is the continuation
-                # of a previous one
-                elif _is_continued_block(line):
-                    last_group.extend(line)
-                else:
-                    new_group = cls(last_group, last_created_group)
-                    last_created_group = new_group
-                    yield new_group
-                    last_group = line.copy()
-            # otherwise put it in the current group
-            else:
-                last_group.extend(line)
+            if indent_level == 0 and idx > first_line:
+                # have to check for decorators, and if the block
+                # is the continuation of a previous one
+                if is_decorator(lines[idx-1]) or _is_continued_block(line):
+                    continue
+                new_group = make_group(first_line, idx, last_created_group)
+                last_created_group = new_group
+                yield new_group
+                first_line = idx
         # if the last group is not closed, put it with the others
-        if last_group:
-            new_group = cls(last_group, last_created_group)
-            last_created_group = new_group
-            yield new_group
+        if first_line < len(lines):
+            yield make_group(first_line, len(lines), last_created_group)
+
+    @classmethod
+    def iterate_cells_from_source(cls, readline):
+        """split the source in cells, delimited by the :code:`# %%`
+        comments, joining the code groups of each cell in a single one.
+
+        the docstrings still form groups of their own, so the code before
+        and after an isolated docstring goes in two different groups.
+        """
+        cell = []
+        last_created_group = None
+        for group in cls.iterate_groups_from_source(readline):
+            if cell and (group.is_docstring() or _starts_cell(group)):
+                last_created_group = cls.join(cell, last_created_group)
+                yield last_created_group
+                cell = []
+            if group.is_docstring():
+                last_created_group = cls.join([group], last_created_group)
+                yield last_created_group
+            else:
+                cell.append(group)
+        if cell:
+            yield cls.join(cell, last_created_group)
+
+    @classmethod
+    def join(cls, groups, previous_block=None):
+        """a single group with the code of the given consecutive groups"""
+        group = cls([token for old in groups for token in old.tokens],
+                    previous_block)
+        group._lines = [line for old in groups for line in old.lines]
+        group._source = "".join(str(old) for old in groups)
+        if all(old._line_sources is not None for old in groups):
+            group._line_sources = [line_source for old in groups
+                                   for line_source in old._line_sources]
+        group._docstring = _is_docstring(group.tokens)
+        if groups[0].line_range and groups[-1].line_range:
+            group.line_range = (groups[0].line_range[0],
+                                groups[-1].line_range[1])
+        return group
+
+
+# %%
+"""
+The Result Cache
+================
+
+Executing a long analysis script can take a lot of time, while most of the
+edits happen in the text or at the end of the script.
+The results of each executed block are stored on disk, in a cache directory
+inside the output directory, under a key that depends on the source of the
+block, on the source of all the code blocks that precede it and on the argv
+given to the script.
+Docstring blocks are not part of the chain, as they can't change the state
+of the execution: editing the text never invalidates the cache.
+
+The cache has a maximum size, and when it is exceeded the least recently
+used entries are removed.
+
+The cache is used only when requested, as it can't know about anything
+else the blocks depend on: if a block reads a data file, the clock, the
+network or a module that has been modified, its stored results are
+reused anyway, and are stale. In that case the cache should be disabled,
+or cleared removing the :code:`.literate_cache` directory.
+"""
+
+_CACHE_VERSION = 1
+
+
+def _chain_cache_keys(groups, argv, settings=None):
+    """assign to each code group the key under which its results are cached
+
+    the key of each block depends on the key of the previous code block,
+    so a change in a block invalidates all the blocks that follow it.
+    The settings (a dictionary) changing the results, like the format of
+    the figures or the lines of output kept, are part of the keys as well.
+    """
+    seed = "literate-cache-{}\n{!r}".format(_CACHE_VERSION, list(argv))
+    if settings:
+        seed += "\n{!r}".format(sorted(settings.items()))
+    state = hashlib.sha256(seed.encode('utf-8')).hexdigest()
+    for group in groups:
+        if group.is_docstring():
+            group.cache_key = None
+            continue
+        payload = (state + '\n' + str(group)).encode('utf-8')
+        state = hashlib.sha256(payload).hexdigest()
+        group.cache_key = state
+    return [group.cache_key for group in groups]
+
+
+class ResultCache(object):
+    """persistent storage of the results of the executed blocks
+
+    Each entry is a pickle file named after its key. The modification time
+    of the files is used to track the last usage, and the least recently
+    used entries are removed when the total size exceeds max_size bytes.
+    """
+    extension = '.pickle'
+
+    def __init__(self, cache_dir, max_size=256*1024**2):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.sizes = {}
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith(self.extension):
+                self.sizes[entry.name] = entry.stat().st_size
+        self.total_size = sum(self.sizes.values())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.extension)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """returns the results stored under the key, or None if missing"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                results = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # mark the entry as recently used
+        os.utime(path)
+        return results
+
+    def put(self, key, results):
+        """store the results under the key, evicting the old entries"""
+        name = key + self.extension
+        data = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+        # an interrupted write must not leave a truncated entry
+        path = self._path(key)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+        self.total_size += len(data) - self.sizes.get(name, 0)
+        self.sizes[name] = len(data)
+        self.evict()
+
+    def evict(self):
+        """remove the least recently used entries until the cache fits"""
+        if self.total_size <= self.max_size:
+            return
+        by_usage = []
+        for name in self.sizes:
+            try:
+                path = os.path.join(self.cache_dir, name)
+                last_used = os.stat(path).st_mtime
+            except OSError:
+                last_used = 0
+            by_usage.append((last_used, name))
+        for last_used, name in sorted(by_usage):
+            if self.total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            self.total_size -= self.sizes.pop(name)
+
+
+def _first_cache_miss(groups, cache, output_dir=None):
+    """index of the first code group whose results are not in the cache
+
+    if the output directory is given, the results whose files (figures
+    and whole outputs) have been removed from it count as missing.
+    """
+    for idx, group in enumerate(groups):
+        if group.cache_key is None:
+            continue
+        if output_dir is None:
+            if group.cache_key not in cache:
+                return idx
+            continue
+        results = cache.get(group.cache_key)
+        if results is None:
+            return idx
+        for f_name in _results_files(results):
+            if not os.path.exists(os.path.join(output_dir, f_name)):
+                return idx
+    return len(groups)
+
+
+# %%
+"""
+Checkpoints of the Globals
+==========================
+
+The result cache alone is not enough to resume the execution in the middle
+of a script, as the blocks that follow need the state built by the previous
+ones. The :code:`Checkpointer` takes a snapshot of the globals after the
+selected blocks, serializing them with pickle.
+
+Modules are stored by name and imported again when restored, and the
+functions defined in the script are stored by their code. The classes
+defined in the script can't be found by pickle in the :code:`__main__`
+module, so they are stored with their attributes and created again.
+Everything else has to be picklable: the names that can't be pickled
+(like open files) are reported, and a checkpoint that misses some names
+is never used to resume the execution. A checkpoint that can't be loaded
+anyway is skipped with a warning, and the script is executed from the
+start.
+
+Only the globals are saved: the internal state of the imported modules
+(random generators, open figures, configurations) is not restored.
+"""
+
+
+def _restore_function(code, name, defaults, kwdefaults, glob):
+    function = types.FunctionType(marshal.loads(code), glob, name, defaults)
+    function.__kwdefaults__ = kwdefaults
+    return function
+
+
+def _restore_class(metaclass, name, bases, attributes):
+    return metaclass(name, bases, attributes)
+
+
+class _GlobalsPickler(pickle.Pickler):
+    """pickler that stores modules and script functions by reference
+
+    shared maps the id of the objects that the receiving side already has
+    to the pair of the global name bound to them and the object itself,
+    that keeps the id from being reused. These objects are stored by name,
+    so that the new globals keep referring to them.
+    With script_classes the classes defined in the script are stored by
+    their attributes, restoring them creates new classes.
+    """
+    def __init__(self, file, glob, shared=None, script_classes=False):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.glob = glob
+        self.shared = shared or {}
+        self.script_classes = script_classes
+
+    def reducer_override(self, obj):
+        is_script_class = (self.script_classes and isinstance(obj, type) and
+                           obj.__module__ == self.glob.get('__name__') and
+                           self.glob.get(obj.__name__) is obj)
+        if not is_script_class:
+            return NotImplemented
+        attributes = {name: value for name, value in vars(obj).items()
+                      if name not in ('__dict__', '__weakref__')}
+        return (_restore_class,
+                (type(obj), obj.__name__, obj.__bases__, attributes))
+
+    def persistent_id(self, obj):
+        if isinstance(obj, types.ModuleType):
+            return ('module', obj.__name__)
+        if id(obj) in self.shared:
+            return ('shared', self.shared[id(obj)][0])
+        is_function = isinstance(obj, types.FunctionType)
+        if is_function and obj.__globals__ is self.glob:
+            if obj.__closure__:
+                raise pickle.PicklingError("closures can't be checkpointed")
+            code = marshal.dumps(obj.__code__)
+            return ('function', code, obj.__name__,
+                    obj.__defaults__, obj.__kwdefaults__)
+        return None
+
+
+class _GlobalsUnpickler(pickle.Unpickler):
+    def __init__(self, file, glob):
+        super().__init__(file)
+        self.glob = glob
+
+    def persistent_load(self, pid):
+        if pid[0] == 'module':
+            return importlib.import_module(pid[1])
+        elif pid[0] == 'function':
+            return _restore_function(*pid[1:], glob=self.glob)
+        elif pid[0] == 'shared':
+            return self.glob[pid[1]]
+        raise pickle.UnpicklingError("unknown reference {}".format(pid[0]))
+
+
+def _dumps_globals(values, glob, shared=None, script_classes=False):
+    file = BytesIO()
+    _GlobalsPickler(file, glob, shared, script_classes).dump(values)
+    return file.getvalue()
+
+
+class Checkpointer(object):
+    """takes and restores snapshots of the globals after selected blocks
+
+    every: take a snapshot every this many code blocks (0 to disable)
+    blocks: indexes of the blocks after which a snapshot is taken
+
+    The snapshots are stored in a :code:`ResultCache`, under the same
+    key of the results of the block, so they share the same invalidation
+    and eviction rules.
+    """
+    def __init__(self, checkpoint_dir, every=0, blocks=(), max_size=1024**3):
+        self.storage = ResultCache(checkpoint_dir, max_size)
+        self.every = every
+        self.blocks = set(blocks)
+        self.reports = []
+
+    def should_checkpoint(self, index):
+        if index in self.blocks:
+            return True
+        return bool(self.every) and (index + 1) % self.every == 0
+
+    def save(self, key, glob, index):
+        """snapshot the globals, return a report of the operation"""
+        start = time.perf_counter()
+        values = {name: value for name, value in glob.items()
+                  if name != '__builtins__'}
+        unpicklable = {}
+        try:
+            payload = _dumps_globals(values, glob, script_classes=True)
+        except Exception:
+            # find out which names are responsible, and drop them
+            for name, value in list(values.items()):
+                try:
+                    _dumps_globals(value, glob, script_classes=True)
+                except Exception as e:
+                    unpicklable[name] = "{}: {}".format(
+                        type(value).__name__, e)
+                    del values[name]
+            payload = _dumps_globals(values, glob, script_classes=True)
+        self.storage.put(key, {'payload': payload,
+                               'unpicklable': unpicklable})
+        report = {'block': index,
+                  'size': len(payload),
+                  'time': time.perf_counter() - start,
+                  'unpicklable': unpicklable,
+                  }
+        self.reports.append(report)
+        return report
+
+    def restore(self, key, glob):
+        """update the globals with the snapshot stored under the key
+
+        returns False if the snapshot is missing, incomplete or can't be
+        loaded, in the last case printing a warning
+        """
+        start = time.perf_counter()
+        snapshot = self.storage.get(key)
+        if snapshot is None or snapshot['unpicklable']:
+            return False
+        file = BytesIO(snapshot['payload'])
+        try:
+            values = _GlobalsUnpickler(file, glob).load()
+        except Exception as e:
+            print("the checkpoint can't be restored, the script is executed "
+                  "from the start: {!r}".format(e), file=sys.stderr)
+            return False
+        glob.update(values)
+        self.reports.append({'restored': True,
+                             'size': len(snapshot['payload']),
+                             'time': time.perf_counter() - start,
+                             })
+        return True
+
+    def is_complete(self, key):
+        snapshot = self.storage.get(key)
+        return snapshot is not None and not snapshot['unpicklable']
+
+    def latest_before(self, groups, index):
+        """index of the last block before the given one with a usable
+        snapshot, or None if there is none
+        """
+        for idx in range(index-1, -1, -1):
+            key = groups[idx].cache_key
+            if key is not None and self.is_complete(key):
+                return idx
+        return None
+
+
+def _format_checkpoint_report(report):
+    """human readable description of a snapshot operation"""
+    size = "{:.1f} kB".format(report['size'] / 1024)
+    if report.get('restored'):
+        text = "restored checkpoint: {} in {:.3f}s"
+        return text.format(size, report['time'])
+    text = "checkpoint after block {}: {} in {:.3f}s"
+    text = text.format(report['block'], size, report['time'])
+    for name, reason in sorted(report['unpicklable'].items()):
+        text += "\n    not saved, can't be pickled: {} ({})".format(
+            name, reason)
+    return text
+
+
+# %%
+"""
+Parallel Execution of Independent Blocks
+========================================
+
+Blocks that don't depend on each other, like separate simulations that only
+read constants defined earlier, can be executed at the same time.
+Each block is analysed with :code:`ast` to find the global names it reads
+and writes, following the functions defined in the script that it uses.
+Two blocks depend on each other if one of them writes a name that the other
+reads or writes.
+
+The blocks are then grouped in levels: each block goes in the level after
+the last one containing a block it depends on. The blocks of a level are
+executed in forked worker processes, starting from the globals left by the
+previous levels, and the names they write are sent back to the main process.
+The results are attached to their blocks, so the report keeps the order of
+the source.
+
+Some blocks have side effects that can't be followed, and act as barriers
+executed alone in the main process, after all the blocks before them:
+
+* :code:`global` and :code:`nonlocal` statements
+* calls to :code:`exec`, :code:`eval`, :code:`open` and similar builtins
+* assignments to attributes or items of existing objects
+* method calls on objects that are not modules, as they could modify them
+* the same inside the functions, on their arguments and on the local names
+  that could refer to objects reached through them
+* calls to modules with a global state, like pylab and random
+* calls to modules that could read or write files or the network: only the
+  modules doing computations (like math and numpy) are called in the
+  workers, except for their functions loading or saving data
+* class definitions and the blocks using the classes defined in the script,
+  as their instances can't be sent back from the workers
+* top-level :code:`await`, as the event loop and its tasks live in the
+  main process
+
+The names written in a worker are pickled and sent back to the main
+process: the objects that the block reached through the names it reads are
+sent as references, so that aliases keep pointing to the same objects.
+
+The option of profiling, tracing the memory, taking checkpoints and
+isolating the blocks can't be combined with the parallel execution.
+"""
+
+_BARRIER_CALLS = frozenset(['exec', 'eval', 'compile', 'open', 'input',
+                            'globals', 'locals', 'vars', '__import__',
+                            'setattr', 'delattr', 'breakpoint'])
+_STATEFUL_MODULES = ('matplotlib', 'pylab', 'seaborn', 'random',
+                     'numpy.random')
+# the modules whose functions can be called in the workers
+_PURE_MODULES = frozenset(['math', 'cmath', 'statistics', 'fractions',
+                           'decimal', 'numbers', 'itertools', 'functools',
+                           'operator', 'collections', 'copy', 'string', 're',
+                           'textwrap', 'bisect', 'heapq', 'json', 'numpy',
+                           'scipy'])
+# functions of these modules that load or save data, like numpy.loadtxt
+_IO_FUNCTION = re.compile(r'(load|save|read|write|dump|open|fromfile|tofile'
+                          r'|genfromtxt|memmap)')
+
+
+def _module_call_barrier(dotted):
+    """the reason a call to a module function is a barrier, or None"""
+    for module_name in _STATEFUL_MODULES:
+        if (dotted + '.').startswith(module_name + '.'):
+            return 'uses {}'.format(module_name)
+    parts = dotted.split('.')
+    if parts[0] not in _PURE_MODULES or _IO_FUNCTION.match(parts[-1]):
+        return 'calls {}, that could do I/O'.format(dotted)
+    return None
+
+
+def _dotted_name(node):
+    """the list of names of an attribute chain like a.b.c, or None"""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return parts[::-1]
+
+
+def _assigned_names(node):
+    """names bound anywhere inside the node, used for the function locals"""
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and not isinstance(child.ctx, ast.Load):
+            names.add(child.id)
+        elif isinstance(child, ast.arg):
+            names.add(child.arg)
+        elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef,
+                                ast.ClassDef)):
+            names.add(child.name)
+    return names
+
+
+def _argument_names(node):
+    """the arguments of a function or lambda, and the local names bound to
+    values computed from them, that could refer to the objects passed"""
+    names = {child.arg for child in ast.walk(node.args)
+             if isinstance(child, ast.arg)}
+    bindings = []
+    for child in ast.walk(node):
+        if isinstance(child, ast.Assign):
+            bindings.append((child.targets, child.value))
+        elif isinstance(child, (ast.AnnAssign, ast.NamedExpr)):
+            if child.value is not None:
+                bindings.append(([child.target], child.value))
+        elif isinstance(child, (ast.For, ast.AsyncFor, ast.comprehension)):
+            bindings.append(([child.target], child.iter))
+        elif isinstance(child, ast.withitem):
+            if child.optional_vars is not None:
+                bindings.append(([child.optional_vars], child.context_expr))
+    changed = True
+    while changed:
+        changed = False
+        for targets, value in bindings:
+            if not any(isinstance(item, ast.Name) and item.id in names
+                       for item in ast.walk(value)):
+                continue
+            for target in targets:
+                for item in ast.walk(target):
+                    if isinstance(item, ast.Name) and item.id not in names:
+                        names.add(item.id)
+                        changed = True
+    return names
+
+
+class _DataflowVisitor(ast.NodeVisitor):
+    """collects the global names read and written by a block
+
+    modules maps the names bound by the import statements seen up to now
+    to the name of the imported module.
+    For the functions and classes defined at the top level the global
+    names they read and the reason they are barriers are stored apart,
+    as they only matter for the blocks that use them.
+    """
+    def __init__(self, modules):
+        self.modules = modules
+        self.reads = set()
+        self.writes = set()
+        self.barrier = None
+        self.function_reads = {}
+        self.function_barriers = {}
+        # local names of the function being visited, None at the top level
+        self.local_names = None
+        # the local names that could refer to the objects passed to it
+        self.argument_names = set()
+
+    def set_barrier(self, reason):
+        if self.barrier is None:
+            self.barrier = reason
+
+    def is_global(self, name):
+        return self.local_names is None or name not in self.local_names
+
+    def visit_Name(self, node):
+        if not self.is_global(node.id):
+            return
+        if isinstance(node.ctx, ast.Load):
+            self.reads.add(node.id)
+        elif self.local_names is None:
+            self.writes.add(node.id)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            name = alias.asname or alias.name.split('.')[0]
+            if self.local_names is None:
+                self.writes.add(name)
+                self.modules[name] = alias.name if alias.asname else name
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            name = alias.asname or alias.name
+            if self.local_names is None:
+                self.writes.add(name)
+                # also the functions, to check the calls to them
+                self.modules[name] = '{}.{}'.format(node.module, alias.name)
+
+    def visit_Global(self, node):
+        self.set_barrier('global statement')
+
+    visit_Nonlocal = visit_Global
+
+    def _visit_scope(self, node, local_names, argument_names=frozenset()):
+        """visit the body of a function or class in its own scope"""
+        old = (self.reads, self.barrier, self.local_names,
+               self.argument_names)
+        self.reads, self.barrier = set(), None
+        self.local_names = (old[2] or set()) | local_names
+        self.argument_names = old[3] | argument_names
+        for child in node.body:
+            self.visit(child)
+        reads, barrier = self.reads, self.barrier
+        (self.reads, self.barrier, self.local_names,
+         self.argument_names) = old
+        if self.local_names is None:
+            self.writes.add(node.name)
+            self.function_reads[node.name] = reads
+            if barrier is not None:
+                self.function_barriers[node.name] = barrier
+        else:
+            self.reads |= reads
+            if barrier is not None:
+                self.set_barrier(barrier)
+
+    def visit_FunctionDef(self, node):
+        for child in node.decorator_list + node.args.defaults:
+            self.visit(child)
+        for child in node.args.kw_defaults:
+            if child is not None:
+                self.visit(child)
+        self._visit_scope(node, _assigned_names(node), _argument_names(node))
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        for child in node.decorator_list + node.bases + node.keywords:
+            self.visit(child)
+        self._visit_scope(node, set())
+        if self.local_names is None:
+            self.set_barrier('defines a class')
+            self.function_barriers[node.name] = 'class defined in the script'
+
+    def visit_Lambda(self, node):
+        for child in node.args.defaults:
+            self.visit(child)
+        old = (self.local_names, self.argument_names)
+        self.local_names = (old[0] or set()) | _assigned_names(node.args)
+        self.argument_names = old[1] | _argument_names(node)
+        self.visit(node.body)
+        self.local_names, self.argument_names = old
+
+    def _check_store_target(self, target):
+        if isinstance(target, (ast.Attribute, ast.Subscript)):
+            root = target.value
+            while isinstance(root, (ast.Attribute, ast.Subscript)):
+                root = root.value
+            if not isinstance(root, ast.Name) or self.is_global(root.id):
+                self.set_barrier('modifies an existing object')
+            elif root.id in self.argument_names:
+                self.set_barrier('modifies the argument {}'.format(root.id))
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            for element in target.elts:
+                self._check_store_target(element)
+        elif isinstance(target, ast.Starred):
+            self._check_store_target(target.value)
+
+    def visit_Assign(self, node):
+        targets = node.targets
+        is_function = (self.local_names is None and len(targets) == 1 and
+                       isinstance(targets[0], ast.Name) and
+                       isinstance(node.value, ast.Lambda))
+        if is_function:
+            # a lambda bound to a name is followed like a function
+            old = (self.reads, self.barrier)
+            self.reads, self.barrier = set(), None
+            self.visit(node.value)
+            name = targets[0].id
+            self.function_reads[name] = self.reads
+            if self.barrier is not None:
+                self.function_barriers[name] = self.barrier
+            self.reads, self.barrier = old
+            self.writes.add(name)
+            return
+        for target in targets:
+            self._check_store_target(target)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        self._check_store_target(node.target)
+        if isinstance(node.target, ast.Name):
+            self.visit_Name(ast.Name(node.target.id, ast.Load()))
+        self.generic_visit(node)
+
+    visit_AnnAssign = visit_AugAssign
+
+    def visit_Delete(self, node):
+        for target in node.targets:
+            self._check_store_target(target)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Name):
+            if not self.is_global(func.id):
+                pass
+            elif func.id in _BARRIER_CALLS:
+                self.set_barrier('calls {}'.format(func.id))
+            elif func.id in self.modules:
+                reason = _module_call_barrier(self.modules[func.id])
+                if reason is not None:
+                    self.set_barrier(reason)
+        elif isinstance(func, ast.Attribute):
+            parts = _dotted_name(func)
+            if parts is None:
+                pass
+            elif not self.is_global(parts[0]):
+                if parts[0] in self.argument_names:
+                    self.set_barrier('method call on the argument {}'
+                                     .format(parts[0]))
+            elif parts[0] not in self.modules:
+                self.set_barrier('method call on {}'.format(parts[0]))
+            else:
+                dotted = '.'.join([self.modules[parts[0]]] + parts[1:])
+                reason = _module_call_barrier(dotted)
+                if reason is not None:
+                    self.set_barrier(reason)
+        self.generic_visit(node)
+
+
+class BlockDataflow(object):
+    """reads, writes and barrier status of the code groups of a script"""
+    def __init__(self, groups):
+        self.groups = groups
+        self.reads = []
+        self.writes = []
+        self.barriers = []
+        modules = {}
+        function_reads = {}
+        function_barriers = {}
+        for group in groups:
+            visitor = _DataflowVisitor(modules)
+            try:
+                visitor.visit(ast.parse(str(group)))
+            except SyntaxError:
+                visitor.set_barrier('syntax error')
+            reads = set(visitor.reads)
+            barrier = visitor.barrier
+            # the tasks of the event loop live in the main process
+            if barrier is None and _uses_event_loop(str(group)):
+                barrier = 'uses top-level await'
+            # follow the functions defined in the script
+            to_visit = list(reads)
+            while to_visit:
+                name = to_visit.pop()
+                if name in function_barriers and barrier is None:
+                    barrier = 'uses {}: {}'.format(name,
+                                                   function_barriers[name])
+                for read in function_reads.get(name, ()):
+                    if read not in reads:
+                        reads.add(read)
+                        to_visit.append(read)
+            for name in visitor.writes:
+                function_reads.pop(name, None)
+                function_barriers.pop(name, None)
+            function_reads.update(visitor.function_reads)
+            function_barriers.update(visitor.function_barriers)
+            self.reads.append(reads)
+            self.writes.append(visitor.writes)
+            self.barriers.append(barrier)
+
+    def depends(self, idx_a, idx_b):
+        writes_a, writes_b = self.writes[idx_a], self.writes[idx_b]
+        return bool(writes_a & (self.reads[idx_b] | writes_b) or
+                    writes_b & self.reads[idx_a])
+
+    def schedule(self, start=0):
+        """divide the groups from start in a list of steps
+
+        each step is a list of group indexes that can be executed
+        together. Barriers and docstrings are alone in their steps.
+        """
+        steps = []
+        levels = []
+        for idx in range(start, len(self.groups)):
+            if self.groups[idx].is_docstring():
+                steps.append([idx])
+            elif self.barriers[idx] is not None:
+                steps.extend(levels)
+                steps.append([idx])
+                levels = []
+            else:
+                level = 0
+                for level_idx, level_groups in enumerate(levels):
+                    if any(self.depends(other, idx) for other in level_groups):
+                        level = level_idx + 1
+                if level == len(levels):
+                    levels.append([])
+                levels[level].append(idx)
+        steps.extend(levels)
+        return steps
+
+
+# the state shared with the forked workers
+_FORK_STATE = {}
+
+
+def _execute_forked(index):
+    """execute a group in a forked worker, returns the results and the
+    pickled globals written by the group
+    """
+    groups = _FORK_STATE['groups']
+    glob = _FORK_STATE['glob']
+    dataflow = _FORK_STATE['dataflow']
+    parent_cage = _FORK_STATE['cage']
+    sink = None
+    if parent_cage.sink is not None:
+        sink = FigureSink(parent_cage.sink.output_dir,
+                          **parent_cage.sink.options)
+    cage = OutputCage(sink, parent_cage.close_figures,
+                      parent_cage.output_lines)
+    # the objects reached through the names read by the group are left
+    # where they are in the main process
+    shared = {id(glob[name]): (name, glob[name])
+              for name in dataflow.reads[index] if name in glob}
+    try:
+        results = groups[index].execute(glob, cage)
+        writes = dataflow.writes[index]
+        written = {name: glob[name] for name in writes if name in glob}
+        deleted = [name for name in writes if name not in glob]
+        try:
+            payload = _dumps_globals(written, glob, shared)
+        except Exception as e:
+            raise RuntimeError("the names written by block {} can't be sent "
+                               "back from the worker, execute it without "
+                               "parallel blocks: {}".format(index, e))
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(str(e))
+        return ('error', e)
+    report = sink.write_report if sink is not None else {}
+    return ('ok', results, payload, deleted, report)
+
+
+def _run_forked(function, args, connection):
+    try:
+        connection.send(function(*args))
+    finally:
+        connection.close()
+
+
+def _fork_map(function, args_list, jobs=None):
+    """call the function with each tuple of arguments in a forked process,
+    at most jobs at a time (by default one per CPU)
+
+    the processes are not daemonic, so they can start processes of their
+    own. Returns the results in the order of args_list, None for the
+    processes that died without sending one.
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait
+    context = multiprocessing.get_context('fork')
+    jobs = jobs or os.cpu_count() or 1
+    results = [None] * len(args_list)
+    running = {}
+    pending = list(enumerate(args_list))
+    while pending or running:
+        while pending and len(running) < jobs:
+            position, args = pending.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_forked,
+                                      args=(function, args, sender))
+            process.start()
+            sender.close()
+            running[receiver] = (position, process)
+        for receiver in wait(list(running)):
+            position, process = running.pop(receiver)
+            try:
+                results[position] = receiver.recv()
+            except EOFError:
+                pass
+            receiver.close()
+            process.join()
+    return results
+
+
+def _execute_step(step, jobs):
+    """execute the groups of a step in forked processes, at most jobs at
+    a time, each starting from the current globals
+    """
+    outcomes = _fork_map(_execute_forked, [(idx,) for idx in step], jobs)
+    return [outcome or ('error', RuntimeError(
+                'the worker executing block {} died'.format(idx)))
+            for idx, outcome in zip(step, outcomes)]
+
+
+def _check_parallel_options(parallel_jobs=0, profile=None, memory=False,
+                            checkpoint_every=0, checkpoint_blocks=(),
+                            isolate=False, block_timeout=None,
+                            memory_limit=None, **options):
+    """raises ValueError if the parallel execution is combined with options
+    it can't honor, the other options are ignored
+    """
+    if not parallel_jobs:
+        return
+    conflicts = [name for name, enabled in [
+        ('profiling', profile is not None), ('memory tracing', memory),
+        ('checkpoints', checkpoint_every or checkpoint_blocks),
+        ('isolation', isolate or block_timeout or memory_limit)] if enabled]
+    if conflicts:
+        raise ValueError("the parallel execution of the blocks can't be "
+                         "combined with " + ', '.join(conflicts))
+
+
+def execute_parallel(groups, glob, cage, jobs, start=0, cache=None):
+    """execute the groups from start, running independent ones together
+
+    the groups before start are supposed to be already executed. The
+    results of each group are stored in the cache, if given.
+    Every group is executed once, either in the main process or in a
+    forked one: the worker processes are forked for each step, as they
+    start from the globals left by the previous steps.
+    """
+    dataflow = BlockDataflow(groups)
+    interrupted = None
+    for step in dataflow.schedule(start):
+        if len(step) == 1 or jobs <= 1:
+            executed = []
+        else:
+            _FORK_STATE.update(groups=groups, glob=glob, dataflow=dataflow,
+                               cage=cage)
+            try:
+                executed = _execute_step(step, jobs)
+            finally:
+                _FORK_STATE.clear()
+        for position, idx in enumerate(step):
+            group = groups[idx]
+            if executed:
+                outcome = executed[position]
+                if outcome[0] == 'error':
+                    raise outcome[1]
+                group.results = outcome[1]
+                file = BytesIO(outcome[2])
+                glob.update(_GlobalsUnpickler(file, glob).load())
+                for name in outcome[3]:
+                    glob.pop(name, None)
+                if cage.sink is not None:
+                    report = cage.sink.write_report
+                    for key, value in outcome[4].items():
+                        report[key] = report.get(key, 0) + value
+            else:
+                group.execute(glob, cage)
+            if cache is not None and group.cache_key is not None:
+                cache.put(group.cache_key, group.results)
+            if group.results.get("interrupted"):
+                interrupted = idx if interrupted is None else min(interrupted,
+                                                                  idx)
+        if interrupted is not None:
+            break
+    if interrupted is not None:
+        # the groups after the interruption should not have been executed
+        for group in groups[interrupted+1:]:
+            group.results = {}
+
+
+# %%
+"""
+Incremental Rendering
+=====================
+
+Rendering the whole report with docutils takes a time proportional to its
+length, even if a single paragraph changed. The compiled rst of each block
+is rendered separately and its html is stored in a cache, keyed by the rst
+text, so only the new or changed blocks go through docutils. The document
+is then rendered with a placeholder in place of each of these blocks, and
+the placeholders are replaced by the cached html.
+
+This is possible only for the self-contained blocks, whose html does not
+depend on the rest of the document: the blocks with section titles,
+references and targets, math, substitutions, field lists or directives
+acting on the whole document (like :code:`contents`) are left as rst in the
+document, so that the final page is the same as the one of a full render.
+So are the blocks starting or ending with an item of a list or of a
+definition list, as docutils merges it with the items of the blocks next
+to it.
+The text inside literal and code blocks is not considered.
+"""
+
+_RENDER_MARKER = '<!-- literate-fragment {} -->'
+_RENDER_PLACEHOLDER = re.compile(r'<!-- literate-fragment (\d+) -->')
+_RENDER_CACHE_SIZE = 64*1024**2
+_DOCUMENT_RST = re.compile(r"""
+      ^\s*([!-/:-@\[-`{-~])\1{2,}\s*$         # title adornments, transitions
+    | \w_\b | `__?\b | \]_                    # references
+    | ^\s*\.\.\s+(_|\[|\|)                    # targets, footnotes, ...
+    | \|\w[^|]*\|                             # substitution references
+    | ^\s*:[^:\s][^:]*:(\s|$)                 # field lists, docinfo
+    | :math:
+    | ^\s*\.\.\s+(math|contents|sectnum|header|footer|title|meta|include
+                  |role|default-role|class|target-notes)::
+    """, re.VERBOSE | re.MULTILINE)
+
+
+def _rst_prose(rst):
+    """the lines of the rst outside of the literal and code blocks"""
+    literal_indent = None
+    for line in rst.splitlines():
+        indent = len(line) - len(line.lstrip())
+        if literal_indent is not None:
+            if not line.strip() or indent > literal_indent:
+                continue
+            literal_indent = None
+        stripped = line.strip()
+        is_directive = stripped.startswith('.. ')
+        if (stripped.endswith('::') and not is_directive or
+                re.match(r'\.\.\s+(code|code-block|sourcecode)::', stripped)):
+            literal_indent = indent
+        yield line
+
+
+# bullets and enumerators, like "*", "3." or "(b)"
+_LIST_ITEM = re.compile(r'([-*+\u2022\u2023\u2043]|\(?(\d+|#|[a-zA-Z]'
+                        r'|[ivxlcdm]+|[IVXLCDM]+)[.)])(\s|$)')
+
+
+def _has_edge_item(lines):
+    """True if the first or the last top-level paragraph of the rst lines
+    is an item of a list or a definition list, that docutils would merge
+    with the items of the neighbouring pieces"""
+    top = [idx for idx, line in enumerate(lines)
+           if line.strip() and not line[0].isspace()]
+    for idx in top[:1] + top[-1:]:
+        if _LIST_ITEM.match(lines[idx]):
+            return True
+        # a term, directly followed by its indented definition
+        following = lines[idx+1] if idx + 1 < len(lines) else ''
+        if (not lines[idx].startswith('..') and following.strip() and
+                following[0].isspace()):
+            return True
+    return False
+
+
+def _is_self_contained(rst):
+    """True if the rst renders to the same html alone and in the document"""
+    prose = list(_rst_prose(rst))
+    return not (_DOCUMENT_RST.search("\n".join(prose)) or
+                _has_edge_item(prose))
+
+
+def _render_fragments(pieces):
+    """render the html body of many rst pieces with a single docutils run"""
+    marker = _RENDER_MARKER.format('separator')
+    separator = "\n\n.. raw:: html\n\n    {}\n\n".format(marker)
+    body = publish_parts(separator.join(pieces), writer_name='html')['body']
+    fragments = body.split(marker)
+    if len(fragments) != len(pieces):
+        # a piece swallowed a separator, render them one by one
+        fragments = [publish_parts(piece, writer_name='html')['body']
+                     for piece in pieces]
+    return fragments
+
+
+def render_html(pieces, cache=None):
+    """render the compiled rst pieces of the blocks into a whole html page
+
+    the self-contained pieces are taken from the cache, if given, and the
+    missing ones are rendered and stored in it. Returns the html and a
+    report with the number of cacheable and reused pieces, the render time
+    saved (as measured when the reused pieces were rendered) and spent.
+    """
+    start = time.perf_counter()
+    report = {'blocks': len(pieces), 'fragments': 0, 'hits': 0,
+              'time saved': 0.0}
+    fragments = {}
+    missing = []
+    for idx, piece in enumerate(pieces):
+        if cache is None or not _is_self_contained(piece):
+            continue
+        report['fragments'] += 1
+        payload = "literate-render-{}\n{}".format(docutils.__version__, piece)
+        key = hashlib.sha256(payload.encode('utf8')).hexdigest()
+        stored = cache.get(key)
+        if stored is None:
+            missing.append((idx, key))
+        else:
+            fragments[idx] = stored['html']
+            report['hits'] += 1
+            report['time saved'] += stored['time']
+    if missing:
+        render_start = time.perf_counter()
+        rendered = _render_fragments([pieces[idx] for idx, key in missing])
+        elapsed = time.perf_counter() - render_start
+        # the time of the single run is divided according to the length
+        total_length = sum(len(pieces[idx]) for idx, key in missing) or 1
+        for (idx, key), html in zip(missing, rendered):
+            fragments[idx] = html
+            piece_time = elapsed * len(pieces[idx]) / total_length
+            cache.put(key, {'html': html, 'time': piece_time})
+    skeleton = []
+    for idx, piece in enumerate(pieces):
+        if idx in fragments:
+            marker = _RENDER_MARKER.format(idx)
+            skeleton.append(".. raw:: html\n\n    {}\n".format(marker))
+        else:
+            skeleton.append(piece)
+    H = publish_parts("\n".join(skeleton), writer_name='html')['whole']
+    H = _RENDER_PLACEHOLDER.sub(lambda m: fragments[int(m.group(1))], H)
+    report['time'] = time.perf_counter() - start
+    return H, report
+
+
+def _format_render_report(report):
+    """one line description of the reuse of the rendered blocks"""
+    text = ("rendered {blocks} blocks in {time:.2f}s: {hits} of {fragments} "
+            "self-contained blocks reused ({rate:.0%}), "
+            "{time saved:.2f}s of rendering saved")
+    rate = report['hits'] / report['fragments'] if report['fragments'] else 0
+    return text.format(rate=rate, **report)
 
 
 # %%
@@ -554,61 +2419,1854 @@ The Main Function
 """
 
 
-def run_file(input_file, output_dir, argv):
+def run_file(input_file, output_dir, argv, use_cache=False,
+             cache_size=256*1024**2, checkpoint_every=0, checkpoint_blocks=(),
+             figure_workers=0, parallel_jobs=0, slowest_blocks=0,
+             close_figures=False, cells=False, profile=None, profile_top=10,
+             profile_threshold=0.1, memory=False, memory_top=5,
+             memory_threshold=1024**2, isolate=False, block_timeout=None,
+             memory_limit=None, output_lines=None, figure_format='png',
+             figure_dpi=None, figure_optimize=None):
+    _check_parallel_options(parallel_jobs, profile, memory, checkpoint_every,
+                            checkpoint_blocks, isolate, block_timeout,
+                            memory_limit)
+    phases = {}
     with open(input_file) as file:
+        start = time.perf_counter()
         origins = file.readline
-        groups = CodeGroup.iterate_groups_from_source(origins)
+        if cells:
+            groups = CodeGroup.iterate_cells_from_source(origins)
+        else:
+            groups = CodeGroup.iterate_groups_from_source(origins)
         groups = list(groups)
-
-        pylab_show_cage = OutputCage()
-        glob = pylab_show_cage.generate_globals()
+        phases['parse'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        encoder = FigureEncoder(figure_workers) if figure_workers else None
+        figure_options = {'fmt': figure_format, 'dpi': figure_dpi,
+                          'optimize': figure_optimize}
+        sink = FigureSink(output_dir, encoder, **figure_options)
+        pylab_show_cage = OutputCage(sink, close_figures, output_lines)
+        glob = pylab_show_cage.generate_globals(argv)
+        profiler = None
+        if profile is not None:
+            profiler = BlockProfiler(profile, profile_top, profile_threshold)
+        tracer = None
+        if memory:
+            tracer = MemoryTracer(memory_top, memory_threshold, profiler)
+        f_base = os.path.splitext(os.path.basename(input_file))[0]
+        dumps = []
+        if profiler is not None:
+            dumps.append((profiler, os.path.join(output_dir,
+                                                 f_base + '.pstats')))
+        if tracer is not None:
+            dumps.append((tracer, os.path.join(output_dir, 'memory.json')))
+        # the kernel is started only if some block has to be executed
+        isolate = isolate or bool(block_timeout or memory_limit)
+        kernel = None
+
+        cache = None
+        render_cache = None
+        checkpointer = None
+        resume_index = 0
+        if use_cache:
+            cache_dir = os.path.join(output_dir, '.literate_cache')
+            cache = ResultCache(cache_dir, cache_size)
+            render_cache = ResultCache(os.path.join(cache_dir, 'render'),
+                                       _RENDER_CACHE_SIZE)
+            _chain_cache_keys(groups, argv,
+                              dict(figure_options, output_lines=output_lines))
+            if (checkpoint_every or checkpoint_blocks) and not isolate:
+                checkpoint_dir = os.path.join(cache_dir, 'checkpoints')
+                checkpointer = Checkpointer(checkpoint_dir, checkpoint_every,
+                                            checkpoint_blocks)
+            # the cached blocks can be skipped if nothing has to be
+            # executed after them, or if their state can be restored
+            first_miss = _first_cache_miss(groups, cache, output_dir)
+            if first_miss == len(groups):
+                resume_index = len(groups)
+            elif checkpointer is not None:
+                restore_index = checkpointer.latest_before(groups, first_miss)
+                if restore_index is not None:
+                    key = groups[restore_index].cache_key
+                    if checkpointer.restore(key, glob):
+                        resume_index = restore_index + 1
 
         do_execute = True
+        try:
+            with pylab_show_cage.session():
+                for idx, group in enumerate(groups):
+                    if not do_execute:
+                        break
+                    if isolate and idx >= resume_index:
+                        if kernel is None:
+                            kernel = IsolatedKernel(
+                                groups, argv, output_dir, close_figures,
+                                block_timeout, memory_limit,
+                                tracer or profiler, dumps, output_lines,
+                                figure_options)
+                        results = kernel.execute(groups, idx)
+                        # the blocks interrupted by a limit are not cached
+                        if (cache is not None and group.cache_key is not None
+                                and results["resource usage"] is not None):
+                            cache.put(group.cache_key, results)
+                        do_execute = not results["interrupted"]
+                        continue
+                    if parallel_jobs and idx >= resume_index:
+                        execute_parallel(groups, glob, pylab_show_cage,
+                                         parallel_jobs, idx, cache)
+                        break
+                    results = group.execute(glob, pylab_show_cage, cache,
+                                            use_cached=idx < resume_index,
+                                            profiler=tracer or profiler)
+                    do_execute = not results["interrupted"]
+                    if (checkpointer is not None and do_execute and
+                            idx >= resume_index and
+                            group.cache_key is not None and
+                            checkpointer.should_checkpoint(idx)):
+                        checkpointer.save(group.cache_key, glob, idx)
+            # what the tasks print from now on goes to the terminal
+            pylab_show_cage.drain_tasks()
+            if kernel is not None:
+                kernel.close()
+        finally:
+            if kernel is not None and kernel.alive:
+                kernel.kill()
+            pylab_show_cage.close_event_loop()
+            # wait for the figures still being rendered
+            sink.close()
+            if tracer is not None:
+                tracer.close()
+        # the figures rendered by the encoder get their final names
         for group in groups:
-            if do_execute:
-                results = group.execute(glob, pylab_show_cage)
-                do_execute = not results["interrupted"]
+            if (group.results and sink.resolve(group.results) and
+                    cache is not None and group.cache_key is not None):
+                cache.put(group.cache_key, group.results)
+        phases['execute'] = time.perf_counter() - start
+        if kernel is None:
+            # otherwise they have been dumped by the kernel process
+            for dumped, path in dumps:
+                dumped.dump(path)
+        if checkpointer is not None:
+            for report in checkpointer.reports:
+                print(_format_checkpoint_report(report))
 
         # close all the obtained figures, as the pylab act as a singleton
         # and stores them. i you launch any code that use pylab after the
         # execution, it will have all the generated figures.
-        import pylab
-        pylab.close('all')
+        pyplot = sys.modules.get('matplotlib.pyplot')
+        if pyplot is not None:
+            pyplot.close('all')
 
         # this will be useful in the future, maybe...
         imported_modules = set()
         for key, value in glob.items():
-            if type(value) == type(pylab):
+            if type(value) == types.ModuleType:
                 imported_modules.add(value)
         for module in imported_modules:
             pass  # print(module.__name__)
 
+    written = [sink.write_report]
+    if kernel is not None:
+        written.append(kernel.write_report)
+    report = write_outputs(groups, input_file, output_dir, render_cache,
+                           phases, slowest_blocks, written)
+    if render_cache is not None:
+        print(_format_render_report(report))
+    print(_format_write_report(report['write']))
+    return True
+
+
+def _default_output_dir(input_file):
+    """the compiled_<name> directory next to the script"""
+    base_dir = os.path.dirname(input_file)
+    filename = os.path.basename(input_file)
+    output_dir = os.path.join(base_dir, 'compiled_{}'.format(filename))
+    return os.path.normpath(output_dir)
+
+
+def write_outputs(groups, input_file, output_dir, render_cache=None,
+                  phases=None, slowest_blocks=0, written=()):
+    """compile the executed groups and write the rst, html and figures
+
+    the time of each phase is added to the phases dictionary (containing
+    the ones of the previous phases, like parse and execution) and written
+    with the resources used by each block in the timings.json file.
+    If slowest_blocks is given the html gets a table of the slowest blocks.
+
+    The files are written only if their content changed, and the figures
+    and whole outputs of previous compilations that are no longer used
+    are removed. written are the reports of the files already written
+    while executing the blocks (see :code:`FigureSink`), counted with
+    the ones written here.
+
+    returns the report of render_html about the reuse of the html of
+    the blocks stored in the render cache, with the report of the
+    written files under the 'write' key.
+    """
+    phases = dict(phases or {})
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     f_base = os.path.basename(input_file)
     f_base = os.path.splitext(f_base)[0]
     filename_complete_rst = os.path.join(output_dir, '{}.rst'.format(f_base))
+    start = time.perf_counter()
     # compile all the block in rst and get the required figures to save
     compile_results = [group.compile(output_dir) for group in groups]
     # attach all the compiled strings for each block
-    compiled_rst = "\n".join(str(piece[0]) for piece in compile_results)
+    rst_pieces = [str(piece[0]) for piece in compile_results]
+    compiled_rst = "\n".join(rst_pieces)
+    phases['compile'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    H, report = render_html(rst_pieces, render_cache)
+    phases['render'] = time.perf_counter() - start
+
+    timings = {'script': input_file, 'phases': phases,
+               'blocks': _block_timings(groups, output_dir)}
+    if slowest_blocks:
+        table = _slowest_blocks_html(groups, timings['blocks'],
+                                     slowest_blocks)
+        H = H.replace('</body>', table + '</body>', 1)
+
+    start = time.perf_counter()
+    write_report = {'written files': 0, 'written bytes': 0,
+                    'skipped files': 0, 'skipped bytes': 0,
+                    'removed files': 0}
+    for other in written:
+        for key, value in other.items():
+            write_report[key] += value
     # saves all the figures as requested by each piece
+    used_files = set()
     for piece in compile_results:
         for f_name, figure_bytes in piece[1].items():
-            f_dir = os.path.join(output_dir, f_name)
-            with open(f_dir, 'wb') as file:
-                file.write(figure_bytes.getvalue())
+            f_path = os.path.join(output_dir, f_name)
+            _write_if_changed(f_path, figure_bytes.getvalue(), write_report)
+            used_files.add(f_name)
+    for group in groups:
+        used_files.update(_results_files(group.results or {}))
+    _remove_stale_files(output_dir, used_files, write_report)
 
-    with open(filename_complete_rst, 'wt') as rst_file:
-        print(compiled_rst, file=rst_file)
+    data = (compiled_rst + '\n').encode('utf8')
+    _write_if_changed(filename_complete_rst, data, write_report)
 
     filename_complete_html = os.path.join(output_dir, '{}.html'.format(f_base))
-    H = publish_parts(compiled_rst, writer_name='html')['whole']
-    with open(filename_complete_html, 'wt') as html_file:
-        print(H, file=html_file)
+    data = (H + '\n').encode('utf8')
+    _write_if_changed(filename_complete_html, data, write_report)
+    phases['write'] = time.perf_counter() - start
+
+    timings['write'] = write_report
+    # the timings of the run, so they are always different
+    data = json.dumps(timings, indent=1).encode('utf8')
+    _write_if_changed(os.path.join(output_dir, 'timings.json'), data, {})
+    report['write'] = write_report
+    return report
+
+
+# the files written for the blocks, that can become stale: the figures
+# named after their hash (see _figure_name) or after their block, as by
+# the previous versions, and the whole outputs of the blocks
+_BLOCK_FILE = re.compile(r'^(figure_[0-9a-f]{20}\.(png|svg|webp|jpg|jpeg|pdf|'
+                         r'eps|ps|tif|tiff)|figure_\d+_\d+\.png|'
+                         r'output_\d+_std(out|err)\.txt(\.\d+\.tmp)?)$')
+
+
+def _results_files(results):
+    """the names of the files written for the results of a block"""
+    names = [f_name for f_name in results.get("generated figures") or ()
+             if isinstance(f_name, str)]
+    names.extend((results.get("output files") or {}).values())
+    return names
+
+
+def _write_if_changed(path, data, report):
+    """write the bytes to the file, unless it already contains them
+
+    the file is replaced through a temporary one, so it is never seen half
+    written. The files and bytes written or skipped are counted in the
+    report. returns whether the file has been written.
+    """
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as file:
+                unchanged = file.read() == data
+        else:
+            unchanged = False
+    except OSError:
+        unchanged = False
+    kind = 'skipped' if unchanged else 'written'
+    report[kind + ' files'] = report.get(kind + ' files', 0) + 1
+    report[kind + ' bytes'] = report.get(kind + ' bytes', 0) + len(data)
+    if unchanged:
+        return False
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+    os.replace(temp_path, path)
+    return True
+
+
+def _replace_if_changed(temp_path, path, report):
+    """move the temporary file to path, or remove it if path already has
+    the same content, counting it in the report as
+    :code:`_write_if_changed`. returns whether path has been replaced.
+    """
+    size = os.path.getsize(temp_path)
+    try:
+        unchanged = (os.path.getsize(path) == size and
+                     filecmp.cmp(temp_path, path, shallow=False))
+    except OSError:
+        unchanged = False
+    kind = 'skipped' if unchanged else 'written'
+    report[kind + ' files'] = report.get(kind + ' files', 0) + 1
+    report[kind + ' bytes'] = report.get(kind + ' bytes', 0) + size
+    if unchanged:
+        os.remove(temp_path)
+        return False
+    os.replace(temp_path, path)
     return True
 
+
+def _remove_stale_files(output_dir, used_files, report):
+    """remove the figures and outputs of the blocks not used anymore"""
+    for entry in os.scandir(output_dir):
+        if (entry.is_file() and _BLOCK_FILE.match(entry.name) and
+                entry.name not in used_files):
+            os.remove(entry.path)
+            report['removed files'] += 1
+
+
+def _format_write_report(report):
+    """one line description of the files written"""
+    text = ("wrote {written bytes} bytes in {written files} files, "
+            "{skipped bytes} bytes in {skipped files} unchanged files "
+            "skipped, {removed files} stale files removed")
+    return text.format(**report)
+
+
+# %%
+"""
+Timings
+=======
+
+Each executed block records in its results the resources it used: wall and
+CPU time, increase of the peak memory of the process, time spent rendering
+the figures and size of the output.
+These are written, together with the time of each phase of the compilation
+(parse, execution, compilation to rst, rendering and writing of the files)
+in the :code:`timings.json` file of the output directory.
+The blocks whose results come from the cache, or from a previous run in
+watch mode, are marked as reused and report the resources of the run that
+produced them.
+"""
+
+
+def _block_timings(groups, output_dir):
+    """the resources used by each executed code block"""
+    blocks = []
+    for group in groups:
+        usage = group.results.get("resource usage")
+        if usage is None:
+            continue
+        figure_bytes = 0
+        for figure in group.results.get("generated figures", []):
+            if isinstance(figure, str):
+                f_path = os.path.join(output_dir, figure)
+                if os.path.exists(f_path):
+                    figure_bytes += os.path.getsize(f_path)
+            else:
+                figure_bytes += len(figure.getbuffer())
+        block = {'index': group.get_index(), 'lines': group.line_range,
+                 'reused': group.reused,
+                 'figures': len(group.results.get("generated figures", [])),
+                 'figure bytes': figure_bytes}
+        block.update(usage)
+        blocks.append(block)
+    return blocks
+
+
+def _slowest_blocks_html(groups, blocks, count):
+    """a collapsible html table of the count slowest blocks"""
+    row = ("<tr><td>{index}</td><td><code>{code}</code></td>"
+           "<td>{wall time:.3f}</td><td>{cpu time:.3f}</td>"
+           "<td>{memory}</td><td>{figure encode time:.3f}</td>"
+           "<td>{reused}</td></tr>\n")
+    rows = []
+    slowest = sorted(blocks, key=lambda block: -block['wall time'])[:count]
+    for block in slowest:
+        lines = str(groups[block['index']]).strip().splitlines()
+        memory = block['peak memory increase']
+        memory = '' if memory is None else '{:.1f}'.format(memory / 1024**2)
+        values = dict(block, code=escape(lines[0] if lines else ''),
+                      memory=memory, reused='yes' if block['reused'] else '')
+        rows.append(row.format(**values))
+    return ('<details class="literate-timings">\n'
+            '<summary>Slowest blocks</summary>\n'
+            '<table class="docutils">\n'
+            '<thead><tr><th>block</th><th>code</th><th>wall time (s)</th>'
+            '<th>cpu time (s)</th><th>memory increase (MB)</th>'
+            '<th>figures (s)</th><th>reused</th></tr></thead>\n'
+            '<tbody>\n' + "".join(rows) + '</tbody>\n</table>\n'
+            '</details>\n')
+
+
+# %%
+"""
+Profiling
+=========
+
+To find where the time of a slow block goes, the blocks can be executed
+under :code:`cProfile`. The statistics of all the profiled blocks are merged
+and saved in the :code:`.pstats` file of the output directory, to be
+explored with the usual tools (:code:`python -m pstats`, snakeviz...), and
+the blocks that took longer than a threshold get in the report a collapsible
+table of the functions with the highest cumulative time.
+
+Profiling slows down the code considerably, so it can be limited to a
+selection of blocks. The results of the blocks taken from the cache are not
+profiled, as their code is not executed.
+"""
+
+
+class BlockProfiler(object):
+    """executes the selected blocks (all if none is given) under cProfile
+
+    the blocks taking at least threshold seconds keep a summary of their top
+    functions by cumulative time in :code:`CodeGroup.profile`.
+    """
+    def __init__(self, blocks=(), top=10, threshold=0.1):
+        self.blocks = frozenset(blocks)
+        self.top = top
+        self.threshold = threshold
+        self.stats = None
+
+    def run(self, group, global_dict):
+        """execute the code of the group, profiling it if selected"""
+        if self.blocks and group.get_index() not in self.blocks:
+            _execute_code(str(group), global_dict)
+            return
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            _execute_code(str(group), global_dict)
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            stats = pstats.Stats(profile)
+            if self.stats is None:
+                self.stats = stats
+            else:
+                self.stats.add(stats)
+            if elapsed >= self.threshold:
+                group.profile = {'time': elapsed,
+                                 'functions': _top_functions(stats, self.top)}
+
+    def dump(self, path):
+        """save the merged statistics, if any block was profiled"""
+        if self.stats is not None:
+            # the same format of pstats.Stats.dump_stats
+            _write_if_changed(path, marshal.dumps(self.stats.stats), {})
+
+
+def _top_functions(stats, count):
+    """name, calls, own and cumulative time of the slowest functions"""
+    entries = sorted(stats.stats.items(), key=lambda entry: -entry[1][3])
+    functions = []
+    for (filename, line, name), (prim_calls, calls, own, cumulative,
+                                 callers) in entries:
+        if filename == __file__ or (filename == '~' and callers and all(
+                caller[0] == __file__ for caller in callers)):
+            # the execution of the block itself
+            continue
+        if filename != '~':
+            name = "{}:{}({})".format(os.path.basename(filename), line, name)
+        if prim_calls != calls:
+            calls = "{}/{}".format(calls, prim_calls)
+        functions.append((name, str(calls), own, cumulative))
+        if len(functions) == count:
+            break
+    return functions
+
+
+def _profile_rst(profile, index):
+    """collapsible rst table of the top functions of a block"""
+    lines = ["", ".. raw:: html", "",
+             '    <details class="literate-profile"><summary>Profile of '
+             'block {}, {:.3f}s</summary>'.format(index, profile['time']),
+             "", ".. list-table::", "   :header-rows: 1", "",
+             "   * - function", "     - calls", "     - own time (s)",
+             "     - cumulative time (s)"]
+    for name, calls, own, cumulative in profile['functions']:
+        lines.extend(["   * - ``{}``".format(name.replace('`', "'")),
+                      "     - " + calls,
+                      "     - {:.4f}".format(own),
+                      "     - {:.4f}".format(cumulative)])
+    lines.extend(["", ".. raw:: html", "", "    </details>", "", ""])
+    return "\n".join(lines)
+
+
+# %%
+"""
+Memory Tracing
+==============
+
+When a script runs out of memory it is hard to tell which block allocated
+what. In memory mode each block is executed under :code:`tracemalloc`, and
+for each block are recorded the memory it allocated and that is still in
+use at its end, its peak, the lines that allocated most of it and the
+largest objects it bound in the globals. Only the allocations of the block
+are traced, so the memory it releases is not subtracted.
+The blocks leaving allocated more than a threshold get an annotation in the
+report, and the records of all the blocks are written in the
+:code:`memory.json` file of the output directory.
+
+Tracing the allocations slows down the execution and uses memory itself,
+so it is meant to be turned on only to investigate.
+"""
+
+
+def _approximate_size(value):
+    """size in bytes of the object and of the items of builtin containers"""
+    size = sys.getsizeof(value, 0)
+    if isinstance(value, dict):
+        items = chain(value.keys(), value.values())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = value
+    else:
+        return size
+    return size + sum(sys.getsizeof(item, 0) for item in items)
+
+
+class MemoryTracer(object):
+    """executes the blocks tracing their allocations with tracemalloc
+
+    the code is executed by the runner, if given (like a
+    :code:`BlockProfiler`). The blocks leaving allocated at least threshold
+    bytes keep a summary of their memory in :code:`CodeGroup.memory`.
+    """
+    def __init__(self, top=5, threshold=1024**2, runner=None):
+        self.top = top
+        self.threshold = threshold
+        self.runner = runner
+        self.records = []
+        self.started = False
+
+    def run(self, group, global_dict):
+        """execute the code of the group, recording its allocations"""
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+        bound = {name: id(value) for name, value in global_dict.items()}
+        # only the memory allocated by the block is traced, so the
+        # snapshot stays small even if the previous blocks used a lot
+        tracemalloc.clear_traces()
+        try:
+            if self.runner is None:
+                _execute_code(str(group), global_dict)
+            else:
+                self.runner.run(group, global_dict)
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            record = {'index': group.get_index(), 'lines': group.line_range,
+                      'net bytes': current, 'peak bytes': peak,
+                      'sites': self._sites(group, snapshot),
+                      'globals': self._new_globals(global_dict, bound)}
+            self.records.append(record)
+            if record['net bytes'] >= self.threshold:
+                group.memory = record
+
+    def _sites(self, group, snapshot):
+        """the lines that allocated the most memory still in use"""
+        import tracemalloc
+        ignored = {tracemalloc.__file__, __file__}
+        if self.runner is not None:
+            # the statistics collected by a profiler
+            ignored.update(module.__file__
+                           for name, module in sys.modules.items()
+                           if name in ('cProfile', 'pstats'))
+        sites = []
+        # the files are ignored once the traces are grouped by line, as
+        # filtering the snapshot trace by trace is slow for large ones
+        for stat in snapshot.statistics('lineno'):
+            frame = stat.traceback[0]
+            if frame.filename in ignored:
+                continue
+            if frame.filename == '<string>' and group.line_range:
+                # the code of the block, shown with the line in the script
+                site = "line {}".format(group.line_range[0] + frame.lineno - 1)
+            else:
+                site = "{}:{}".format(_short_path(frame.filename),
+                                      frame.lineno)
+            sites.append({'site': site, 'bytes': stat.size,
+                          'count': stat.count})
+            if len(sites) == self.top:
+                break
+        return sites
+
+    def _new_globals(self, global_dict, bound):
+        """the largest objects bound to a name by the block"""
+        new = []
+        for name, value in global_dict.items():
+            if bound.get(name) == id(value) or name.startswith('__'):
+                continue
+            if isinstance(value, types.ModuleType):
+                continue
+            new.append({'name': name, 'type': type(value).__name__,
+                        'bytes': _approximate_size(value)})
+        new.sort(key=lambda item: -item['bytes'])
+        return new[:self.top]
+
+    def dump(self, path):
+        """save the records of the traced blocks as json"""
+        data = json.dumps(self.records, indent=1).encode('utf8')
+        _write_if_changed(path, data, {})
+
+    def close(self):
+        """stop tracing, if it was started by the tracer"""
+        import tracemalloc
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+
+def _short_path(filename):
+    """the path of a module relative to the directory it is imported from"""
+    for directory in sorted(filter(None, sys.path), key=len, reverse=True):
+        if filename.startswith(os.path.join(directory, '')):
+            return os.path.relpath(filename, directory)
+    return filename
+
+
+def _format_bytes(size):
+    if abs(size) < 1024**2:
+        return "{:+.1f} kB".format(size / 1024)
+    return "{:+.1f} MB".format(size / 1024**2)
+
+
+def _memory_rst(memory):
+    """rst annotation with the memory left allocated by a block"""
+    lines = ["", ".. admonition:: Memory of block {}: {}, peak {}"
+             .format(memory['index'], _format_bytes(memory['net bytes']),
+                     _format_bytes(memory['peak bytes'])),
+             "    :class: literate-memory", ""]
+    if memory['globals']:
+        lines.append("    * new globals: " + ", ".join(
+            "``{}`` ({}) {}".format(item['name'], item['type'],
+                                    _format_bytes(item['bytes']))
+            for item in memory['globals']))
+    if memory['sites']:
+        lines.append("    * allocated by: " + ", ".join(
+            "``{}`` {}".format(site['site'].replace('`', "'"),
+                               _format_bytes(site['bytes']))
+            for site in memory['sites']))
+    lines.extend(["", ""])
+    return "\n".join(lines)
+
+
+# %%
+"""
+Isolated Execution
+==================
+
+A runaway block (an unexpectedly slow loop, or a huge allocation) would
+hang or kill the whole compilation. The blocks can instead be executed by
+a kernel: a child process, forked once the script has been parsed, that
+keeps the globals and executes the blocks it receives through a pipe,
+sending back their results.
+Each block can be given a maximum time, after which the kernel is killed,
+and the kernel can be given a maximum size of its address space
+(:code:`RLIMIT_AS`, that includes the interpreter and the libraries already
+imported). When a limit is exceeded the block is interrupted, the
+following ones are not executed, and the report is written anyway with the
+reason of the interruption in place of the exception raised by the block.
+
+The kernel starts from an empty state, so the checkpoints are not used,
+and the independent blocks are not executed in parallel.
+"""
+
+
+def _limit_results(message, out='', err='', figures=()):
+    """results of a block interrupted by a limit of the kernel"""
+    return {'standard output': out,
+            "standard error": err,
+            "generated figures": list(figures),
+            "exceptions generated": message,
+            "interrupted": True,
+            "resource usage": None,
+            }
+
+
+def _kernel_main(connection, groups, argv, output_dir, close_figures,
+                 memory_limit, runner, dumps, output_lines, figure_options):
+    """the loop of the kernel process, executing the requested groups"""
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    sink = FigureSink(output_dir, **(figure_options or {}))
+    cage = OutputCage(sink, close_figures, output_lines)
+    glob = cage.generate_globals(argv)
+    with cage.session():
+        for index in iter(connection.recv, None):
+            group = groups[index]
+            try:
+                results = group.execute(glob, cage, profiler=runner)
+            except MemoryError:
+                message = ("MemoryError: the block exceeded the memory limit "
+                           "of {:.0f} MB and has been interrupted, the "
+                           "following blocks have not been executed"
+                           .format(memory_limit / 1024**2))
+                results = _limit_results(message,
+                                         cage._pop_output(cage.my_stdout),
+                                         cage._pop_output(cage.my_stderr),
+                                         cage.get_figures())
+            except Exception as e:
+                try:
+                    pickle.dumps(e)
+                except Exception:
+                    e = RuntimeError(str(e))
+                connection.send(('error', e))
+                continue
+            connection.send(('ok', results, group.profile, group.memory))
+        cage.drain_tasks()
+    cage.close_event_loop()
+    for dumped, path in dumps:
+        dumped.dump(path)
+    connection.send(('closed', sink.write_report))
+
+
+class IsolatedKernel(object):
+    """executes the groups in a child process, with optional limits
+
+    timeout is the maximum time in seconds for each block, memory_limit the
+    maximum size in bytes of the address space of the child process.
+    The runner (like a :code:`BlockProfiler`) is used by the child process
+    to execute the blocks, and the pairs of dumps (an object with a dump
+    method, and a path) are dumped by it when the kernel is closed.
+    The report of the files written by the child process is in
+    write_report once the kernel is closed.
+    """
+    def __init__(self, groups, argv, output_dir, close_figures=False,
+                 timeout=None, memory_limit=None, runner=None, dumps=(),
+                 output_lines=None, figure_options=None):
+        import multiprocessing
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.write_report = {}
+        context = multiprocessing.get_context('fork')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_kernel_main, daemon=True,
+            args=(child_connection, groups, argv, output_dir, close_figures,
+                  memory_limit, runner, dumps, output_lines,
+                  figure_options))
+        self.process.start()
+        child_connection.close()
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def execute(self, groups, index):
+        """execute the group with the given index, returns its results
+
+        the exceptions raised by the script are raised again, while the
+        exceeded limits are reported in the results.
+        """
+        group = groups[index]
+        group.reused = False
+        self.connection.send(index)
+        if self.connection.poll(self.timeout):
+            try:
+                answer = self.connection.recv()
+            except EOFError:
+                answer = None
+        else:
+            self.kill()
+            answer = ('limit', "TimeoutError: the block exceeded the time "
+                      "limit of {}s and has been interrupted, the following "
+                      "blocks have not been executed".format(self.timeout))
+        if answer is None:
+            self.process.join()
+            answer = ('limit', "the process executing the block died with "
+                      "exit code {}, the following blocks have not been "
+                      "executed".format(self.process.exitcode))
+        if answer[0] == 'error':
+            raise answer[1]
+        if answer[0] == 'limit':
+            group.results = _limit_results(answer[1])
+        else:
+            group.results, group.profile, group.memory = answer[1:]
+        return group.results
+
+    def close(self):
+        """wait for the tasks of the script and stop the child process"""
+        if self.alive:
+            try:
+                self.connection.send(None)
+                self.write_report = self.connection.recv()[1]
+            except (EOFError, OSError):
+                pass
+            self.process.join()
+        self.connection.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+
+
+# %%
+"""
+Watch Mode
+==========
+
+Most of the time of the edit-compile loop is spent starting the
+interpreter, importing the libraries and running the setup blocks again.
+In watch mode a single process stays alive and monitors the source file.
+When the file is saved it is divided into blocks again and compared with
+the previous version: the blocks before the first changed one keep their
+results, and the execution restarts from the changed block using the live
+globals. As for the cache, the docstring blocks are not considered when
+looking for the first change.
+
+The live globals still contain the names created by the old version of the
+blocks that are executed again, so the results could differ from the ones
+of a clean run.
+"""
+
+
+def _first_changed_group(old_groups, new_groups):
+    """index in new_groups of the first code block that differs from the
+    code blocks of old_groups, or len(new_groups) if none is changed
+    """
+    old_code = [str(group) for group in old_groups
+                if not group.is_docstring()]
+    code_idx = 0
+    for idx, group in enumerate(new_groups):
+        if group.is_docstring():
+            continue
+        if code_idx >= len(old_code) or str(group) != old_code[code_idx]:
+            return idx
+        code_idx += 1
+    return len(new_groups)
+
+
+class Watcher(object):
+    """keeps the globals of a script alive and recompiles it when changed
+    """
+    def __init__(self, input_file, output_dir, argv, slowest_blocks=0,
+                 close_figures=False, cells=False, output_lines=None,
+                 figure_options=None):
+        self.input_file = input_file
+        self.output_dir = output_dir
+        self.slowest_blocks = slowest_blocks
+        self.cells = cells
+        sink = FigureSink(output_dir, **(figure_options or {}))
+        self.cage = OutputCage(sink, close_figures, output_lines)
+        self.glob = self.cage.generate_globals(argv)
+        render_dir = os.path.join(output_dir, '.literate_cache', 'render')
+        self.render_cache = ResultCache(render_dir, _RENDER_CACHE_SIZE)
+        self.render_report = None
+        # the groups that have been executed without errors
+        self.groups = []
+        self.last_mtime = None
+
+    def has_changed(self):
+        mtime = os.stat(self.input_file).st_mtime_ns
+        changed = mtime != self.last_mtime
+        self.last_mtime = mtime
+        return changed
+
+    def update(self):
+        """recompile the file, returns the number of executed blocks
+
+        exceptions raised by the script are not caught, the groups executed
+        up to that point are kept, so the following update will restart
+        from the failed block.
+        """
+        start = time.perf_counter()
+        if self.cells:
+            iterate_groups = CodeGroup.iterate_cells_from_source
+        else:
+            iterate_groups = CodeGroup.iterate_groups_from_source
+        with open(self.input_file) as file:
+            groups = list(iterate_groups(file.readline))
+        phases = {'parse': time.perf_counter() - start}
+        start = time.perf_counter()
+        first_changed = _first_changed_group(self.groups, groups)
+        old_code = (group for group in self.groups
+                    if not group.is_docstring())
+        for group in groups[:first_changed]:
+            if not group.is_docstring():
+                group.results = next(old_code).results
+                group.reused = True
+        executed = 0
+        do_execute = True
+        self.cage.sink.write_report = {}
+        with self.cage.session():
+            for idx, group in enumerate(groups):
+                if idx < first_changed and not group.is_docstring():
+                    do_execute = not group.results.get("interrupted")
+                    continue
+                if not do_execute:
+                    break
+                try:
+                    results = group.execute(self.glob, self.cage)
+                except Exception:
+                    self.groups = groups[:idx]
+                    raise
+                executed += not group.is_docstring()
+                do_execute = not results["interrupted"]
+        self.cage.drain_tasks()
+        self.groups = groups
+        phases['execute'] = time.perf_counter() - start
+        self.render_report = write_outputs(groups, self.input_file,
+                                           self.output_dir, self.render_cache,
+                                           phases, self.slowest_blocks,
+                                           [self.cage.sink.write_report])
+        return executed
+
+    def watch(self, interval=0.5):
+        """check the file every interval seconds, until interrupted"""
+        try:
+            while True:
+                if self.has_changed():
+                    start = time.perf_counter()
+                    try:
+                        executed = self.update()
+                    except Exception:
+                        traceback.print_exc()
+                    else:
+                        elapsed = time.perf_counter() - start
+                        text = "recompiled {} ({} blocks executed) in {:.3f}s"
+                        print(text.format(self.input_file, executed, elapsed))
+                        print(_format_render_report(self.render_report))
+                        print(_format_write_report(
+                            self.render_report['write']))
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+# %%
+"""
+Batch Compilation
+=================
+
+To rebuild a whole directory of reports, the scripts are compiled by
+several worker processes at the same time. The most common libraries are
+imported once, and each script is compiled by a new process forked from
+that state: the scripts don't pay for the imports, and nothing a script
+changes (its modules, the settings of matplotlib, the working
+directory...) is seen by the following ones. The processes are not
+daemonic, so a compilation can start its own figure encoder, kernel or
+parallel blocks.
+
+Each script can be given a maximum time: when it is exceeded the
+compilation of that script is aborted and reported as failed.
+"""
+
+_DEFAULT_PRELOAD = ('docutils.core', 'matplotlib', 'pylab')
+
+
+class CompileTimeout(BaseException):
+    """raised inside a script that exceeded its time limit
+
+    it is not an Exception, so it can't be silenced by the script itself
+    """
+
+
+def _raise_timeout(signum, frame):
+    raise CompileTimeout("time limit exceeded")
+
+
+def _preload_modules(preload):
+    """import the modules, setting the non interactive matplotlib backend"""
+    if 'matplotlib' in preload or 'pylab' in preload:
+        import matplotlib
+        matplotlib.use('Agg')
+    for module_name in preload:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            pass
+
+
+def _compile_in_worker(input_file, timeout, options, output_dir=None,
+                       argv=None):
+    """compile a single script, returns a summary of the compilation"""
+    import signal
+    start = time.perf_counter()
+    error = None
+    if output_dir is None:
+        output_dir = _default_output_dir(input_file)
+    if argv is None:
+        argv = [input_file]
+    if timeout:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        run_file(input_file, output_dir, argv, **options)
+    except CompileTimeout:
+        error = "timed out after {}s".format(timeout)
+    except BaseException as e:
+        # the last line of the message is the original exception
+        message = str(e).strip().splitlines() or ['']
+        error = "{}: {}".format(type(e).__name__, message[-1])
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return {'script': input_file,
+            'time': time.perf_counter() - start,
+            'error': error,
+            }
+
+
+def _collect_scripts(paths):
+    """the python scripts in the given files and directories"""
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                f_path = os.path.join(path, name)
+                if name.endswith('.py') and os.path.isfile(f_path):
+                    scripts.append(os.path.abspath(f_path))
+        else:
+            scripts.append(os.path.abspath(path))
+    return scripts
+
+
+def run_batch(paths, jobs=None, timeout=None, preload=_DEFAULT_PRELOAD,
+              **options):
+    """compile all the scripts in the given files and directories
+
+    jobs is the number of worker processes (by default one per CPU),
+    timeout the maximum time in seconds for each script, and the other
+    options are passed to :code:`run_file`. The preload modules are
+    imported in the calling process.
+    Returns a list with the summary of each compilation, in the order
+    of the scripts.
+    """
+    scripts = _collect_scripts(paths)
+    _preload_modules(preload)
+    # each script is compiled in its own process, that can start the
+    # processes of the figure encoder, of the kernel or of the parallel
+    # blocks
+    summaries = _fork_map(_compile_in_worker,
+                          [(script, timeout, options) for script in scripts],
+                          jobs)
+    return [summary or {'script': script, 'time': 0.0,
+                        'error': 'the worker process died'}
+            for script, summary in zip(scripts, summaries)]
+
+
+def _format_batch_summary(summaries):
+    """table of the compilations, from the slowest"""
+    lines = []
+    for summary in sorted(summaries, key=lambda s: -s['time']):
+        status = 'FAILED' if summary['error'] else 'ok'
+        line = "{:>8.2f}s  {:<6}  {}".format(summary['time'], status,
+                                             summary['script'])
+        if summary['error']:
+            line += "\n            {}".format(summary['error'])
+        lines.append(line)
+    failed = sum(bool(summary['error']) for summary in summaries)
+    total = sum(summary['time'] for summary in summaries)
+    lines.append("{} scripts compiled, {} failed, {:.2f}s of compilation"
+                 .format(len(summaries), failed, total))
+    return "\n".join(lines)
+
+
+# %%
+"""
+Parameter Sweeps
+================
+
+The same script can be compiled for many sets of arguments, for example
+to repeat an analysis on several datasets. The script is parsed once, and
+the blocks at its beginning that don't use the arguments are executed only
+once as well: the runs are forked from the process that executed them,
+each with its own copy of the globals, and write one output directory for
+each set of arguments, collected by an index page.
+
+A block is considered to use the arguments if its code refers to
+:code:`argv` or parses the command line (:code:`parse_args` and the like).
+During the shared part :code:`sys.argv` can't be read, so a block reading
+it in some hidden way is stopped and executed again by each run.
+The shared part ends as well at the first block executed on the event loop
+(see Top-level Await), as its thread would not survive the fork.
+"""
+
+_ARGV_READERS = frozenset(['argv', 'orig_argv', 'parse_args',
+                           'parse_known_args', 'parse_intermixed_args',
+                           'getopt', 'gnu_getopt'])
+
+
+class _ArgvRead(BaseException):
+    """raised reading sys.argv in the blocks shared by a sweep
+
+    it is not an Exception, so it can't be silenced by the script itself
+    """
+
+
+def _guarded(name):
+    method = getattr(list, name)
+
+    def read(self, *args, **kwargs):
+        if self.locked:
+            raise _ArgvRead("sys.argv read before the runs of the sweep")
+        return method(self, *args, **kwargs)
+    return read
+
+
+class _ArgvGuard(list):
+    """the sys.argv of the blocks shared by all the runs of a sweep
+
+    the blocks could keep a reference to it, so each run fills it with
+    its own arguments and unlocks it instead of replacing it.
+    """
+    locked = True
+
+    def unlock(self, argv):
+        list.extend(self, argv)
+        self.locked = False
+
+
+for name in ['__getitem__', '__iter__', '__len__', '__contains__',
+             '__reversed__', '__add__', '__mul__', '__eq__', 'copy', 'count',
+             'index']:
+    setattr(_ArgvGuard, name, _guarded(name))
+del name
+
+
+def _reads_argv(group):
+    """if the code of the group refers to the command line arguments"""
+    if group.is_docstring():
+        return False
+    try:
+        tree = ast.parse(str(group))
+    except SyntaxError:
+        return True
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            name = node.id
+        elif isinstance(node, ast.Attribute):
+            name = node.attr
+        elif isinstance(node, ast.alias):
+            name = node.name.rpartition('.')[2]
+        else:
+            continue
+        if name in _ARGV_READERS:
+            return True
+    return False
+
+
+def _sweep_run_name(position, args):
+    """name of the output directory of a run, readable but safe"""
+    label = re.sub(r'[^\w.=+-]+', '-', '_'.join(args)).strip('-')
+    return '{:03d}_{}'.format(position, label[:40]).rstrip('_')
+
+
+def _sweep_in_worker(position):
+    """complete a run of the sweep in a forked process, returns a summary"""
+    groups = _FORK_STATE['groups']
+    glob = _FORK_STATE['glob']
+    cage = _FORK_STATE['cage']
+    prefix = _FORK_STATE['prefix']
+    input_file = _FORK_STATE['input_file']
+    output_dir = _FORK_STATE['output_dirs'][position]
+    argv = [input_file] + list(_FORK_STATE['argv_sets'][position])
+    guard = _FORK_STATE['guard']
+    start = time.perf_counter()
+    phases = dict(_FORK_STATE['phases'])
+    error = None
+    try:
+        guard.unlock(argv)
+        sys.argv = guard
+        cage.sink = FigureSink(output_dir, **cage.sink.options)
+        # the figures and outputs of the shared blocks are needed by each
+        # report
+        for group in groups[:prefix]:
+            for f_name in _results_files(group.results):
+                f_path = os.path.join(_FORK_STATE['prefix_dir'], f_name)
+                shutil.copy(f_path, output_dir)
+        with cage.session():
+            for group in groups[prefix:]:
+                if group.execute(glob, cage)["interrupted"]:
+                    break
+        cage.drain_tasks()
+        cage.close_event_loop()
+        phases['execute'] += time.perf_counter() - start
+        pyplot = sys.modules.get('matplotlib.pyplot')
+        if pyplot is not None:
+            pyplot.close('all')
+        write_outputs(groups, input_file, output_dir, None, phases,
+                      _FORK_STATE['slowest_blocks'], [cage.sink.write_report])
+    except BaseException as e:
+        # the last line of the message is the original exception
+        message = str(e).strip().splitlines() or ['']
+        error = "{}: {}".format(type(e).__name__, message[-1])
+    return {'argv': argv[1:],
+            'output_dir': output_dir,
+            'time': time.perf_counter() - start,
+            'error': error,
+            }
+
+
+def _write_sweep_index(summaries, input_file, output_dir, shared):
+    """write the rst and html index of the runs of a sweep"""
+    f_base = os.path.splitext(os.path.basename(input_file))[0]
+    title = "Sweep of {}".format(os.path.basename(input_file))
+    lines = [title, "=" * len(title), "",
+             "{} runs, the first {} blocks executed once for all of them."
+             .format(len(summaries), shared), "",
+             ".. list-table::", "   :header-rows: 1", "",
+             "   * - run", "     - arguments", "     - time",
+             "     - status"]
+    for summary in summaries:
+        name = os.path.basename(summary['output_dir'])
+        if summary['error']:
+            run = name
+            status = "failed, {}".format(summary['error'])
+        else:
+            run = "`{} <{}/{}.html>`__".format(name, name, f_base)
+            status = "ok"
+        arguments = shlex.join(summary['argv'])
+        lines.extend(["   * - " + run,
+                      "     - " + ("``{}``".format(arguments)
+                                   if arguments else "none"),
+                      "     - {:.2f}s".format(summary['time']),
+                      "     - " + status])
+    rst = "\n".join(lines) + "\n"
+    with open(os.path.join(output_dir, 'index.rst'), 'w') as file:
+        file.write(rst)
+    html = publish_parts(rst, writer_name='html')['whole']
+    with open(os.path.join(output_dir, 'index.html'), 'w') as file:
+        file.write(html)
+
+
+def run_sweep(input_file, argv_sets, output_dir=None, jobs=None,
+              slowest_blocks=0, close_figures=False, cells=False,
+              output_lines=None, figure_format='png', figure_dpi=None,
+              figure_optimize=None):
+    """compile the script once for each list of arguments in argv_sets
+
+    each run is written in a subdirectory of output_dir (by default the
+    sweep directory inside the usual one of the script), next to an
+    index.html linking all of them. jobs is the number of runs executed
+    together (by default one per CPU). The other options are the ones of
+    :code:`run_file`.
+    Returns a list with the summary of each run, in the order of argv_sets.
+    """
+    import multiprocessing
+    input_file = os.path.abspath(input_file)
+    if output_dir is None:
+        output_dir = os.path.join(_default_output_dir(input_file), 'sweep')
+    output_dirs = [os.path.join(output_dir, _sweep_run_name(position, args))
+                   for position, args in enumerate(argv_sets)]
+    phases = {}
+    with open(input_file) as file:
+        start = time.perf_counter()
+        if cells:
+            groups = CodeGroup.iterate_cells_from_source(file.readline)
+        else:
+            groups = CodeGroup.iterate_groups_from_source(file.readline)
+        groups = list(groups)
+        phases['parse'] = time.perf_counter() - start
+
+    old_argv = sys.argv
+    prefix_dir = tempfile.mkdtemp(prefix='literate_sweep_')
+    sink = FigureSink(prefix_dir, fmt=figure_format, dpi=figure_dpi,
+                      optimize=figure_optimize)
+    cage = OutputCage(sink, close_figures, output_lines)
+    glob = cage.generate_globals([input_file])
+    guard = sys.argv = _ArgvGuard()
+    prefix = 0
+    start = time.perf_counter()
+    try:
+        with cage.session():
+            for group in groups:
+                # the thread of the event loop would not survive the fork
+                if _reads_argv(group) or (not group.is_docstring() and
+                                          _uses_event_loop(str(group))):
+                    break
+                try:
+                    results = group.execute(glob, cage)
+                except _ArgvRead:
+                    # the runs execute it again, drop what it produced
+                    cage._pop_output(cage.my_stdout)
+                    cage._pop_output(cage.my_stderr)
+                    cage.get_figures()
+                    break
+                prefix += 1
+                if results["interrupted"]:
+                    # the script stopped for all the runs
+                    prefix = len(groups)
+                    break
+        phases['execute'] = time.perf_counter() - start
+
+        context = multiprocessing.get_context('fork')
+        _FORK_STATE.update(groups=groups, glob=glob, cage=cage, guard=guard,
+                           prefix=prefix, prefix_dir=prefix_dir,
+                           input_file=input_file, argv_sets=argv_sets,
+                           output_dirs=output_dirs, phases=phases,
+                           slowest_blocks=slowest_blocks)
+        try:
+            # each run gets a fresh process, forked after the shared blocks
+            with context.Pool(jobs, maxtasksperchild=1) as pool:
+                summaries = pool.map(_sweep_in_worker,
+                                     range(len(argv_sets)), chunksize=1)
+        finally:
+            _FORK_STATE.clear()
+    finally:
+        sys.argv = old_argv
+        shutil.rmtree(prefix_dir, ignore_errors=True)
+        pyplot = sys.modules.get('matplotlib.pyplot')
+        if pyplot is not None:
+            pyplot.close('all')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    _write_sweep_index(summaries, input_file, output_dir, prefix)
+    return summaries
+
+
+def _read_argv_sets(path):
+    """the sets of arguments in a file, one per line in shell syntax"""
+    argv_sets = []
+    with open(path) as file:
+        for line in file:
+            if line.strip() and not line.lstrip().startswith('#'):
+                argv_sets.append(shlex.split(line))
+    return argv_sets
+
+
+def _format_sweep_summary(summaries):
+    """table of the runs of a sweep, in their order"""
+    lines = []
+    for summary in summaries:
+        status = 'FAILED' if summary['error'] else 'ok'
+        line = "{:>8.2f}s  {:<6}  {}".format(summary['time'], status,
+                                             shlex.join(summary['argv']))
+        if summary['error']:
+            line += "\n            {}".format(summary['error'])
+        lines.append(line)
+    failed = sum(bool(summary['error']) for summary in summaries)
+    lines.append("{} runs compiled, {} failed".format(len(summaries), failed))
+    return "\n".join(lines)
+
+
+# %%
+"""
+Fork Server
+===========
+
+For many small reports most of the time goes in starting the interpreter
+and importing docutils, matplotlib and the libraries used by the scripts.
+A fork server imports them once and then waits on a Unix socket: for each
+request it forks a child, that already has everything imported and
+compiles the script, writing the same output directory as a normal
+compilation.
+The client sends along its standard output and error, so what the
+compilation prints ends up in its terminal, and gets back the same summary
+of a batch compilation.
+
+Each child is discarded after its compilation, so the scripts can't
+affect each other, apart from the files they write.
+"""
+
+
+def _receive_request(connection):
+    """the request sent by a client, and the file descriptors attached"""
+    import socket
+    data, fds, _, _ = socket.recv_fds(connection, 65536, 2)
+    chunks = [data]
+    while not chunks[-1].endswith(b'\n'):
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads(b''.join(chunks)), fds
+
+
+def _serve_request(connection):
+    """compile the requested script in the forked child"""
+    request, fds = _receive_request(connection)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # the output of the compilation goes to the terminal of the client
+    for target, fd in zip((1, 2), fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    summary = _compile_in_worker(request['script'], request['timeout'],
+                                 request['options'], request['output_dir'],
+                                 request['argv'])
+    sys.stdout.flush()
+    sys.stderr.flush()
+    connection.sendall(json.dumps(summary).encode('utf8'))
+
+
+def serve(socket_path, preload=_DEFAULT_PRELOAD, max_requests=None):
+    """compile the scripts requested on the Unix socket in forked children
+
+    the preloaded modules are imported once, before accepting the requests.
+    The server runs until interrupted, or until it has accepted
+    max_requests requests.
+    """
+    import signal
+    import socket
+    _preload_modules(preload)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    # the children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # the socket appears only once it accepts the connections
+        server.bind(socket_path + '.tmp')
+        server.listen()
+        os.rename(socket_path + '.tmp', socket_path)
+        accepted = 0
+        while max_requests is None or accepted < max_requests:
+            connection, _ = server.accept()
+            accepted += 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if os.fork() == 0:
+                status = 0
+                try:
+                    server.close()
+                    # the compilation waits for its own processes
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    _serve_request(connection)
+                except BaseException:
+                    traceback.print_exc()
+                    status = 1
+                finally:
+                    os._exit(status)
+            connection.close()
+    finally:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        server.close()
+        os.remove(socket_path)
+
+
+def compile_on_server(socket_path, input_file, output_dir=None, argv=None,
+                      timeout=None, **options):
+    """compile a script on the fork server listening on the given socket
+
+    the arguments are the same of :code:`run_file`, with the timeout of
+    :code:`run_batch`. Returns the summary of the compilation.
+    """
+    import socket
+    input_file = os.path.abspath(input_file)
+    if output_dir is None:
+        output_dir = _default_output_dir(input_file)
+    request = {'script': input_file,
+               'output_dir': os.path.abspath(output_dir),
+               'argv': argv if argv is not None else [input_file],
+               'cwd': os.getcwd(),
+               'timeout': timeout,
+               'options': options,
+               }
+    fds = []
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+            fds.append(stream.fileno())
+        except (AttributeError, OSError, ValueError):
+            # without a real file the output stays with the server
+            break
+    message = json.dumps(request).encode('utf8') + b'\n'
+    chunks = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        socket.send_fds(connection, [message], fds)
+        for chunk in iter(lambda: connection.recv(65536), b''):
+            chunks.append(chunk)
+    if not chunks:
+        return {'script': input_file, 'time': 0.0,
+                'error': "the server closed the connection"}
+    return json.loads(b''.join(chunks))
+
+
+# %%
+"""
+Benchmarks
+===========
+
+The functions whose name starts with :code:`benchmark_` measure the
+performance of the various steps, and can be launched from the command line
+with the :code:`--benchmark` option. Each returns a dictionary of measures.
+
+The measures can be saved in a json file with :code:`--benchmark-save` and
+compared with a previous file (for example saved on another commit) with
+:code:`--benchmark-compare`, that marks the ones worse by more than 20%.
+The scripts used are generated by :code:`generate_script`, varying the
+number and length of the blocks, the text, the output and the figures.
+"""
+
+
+def benchmark_output_capture(blocks=2000, block_output=10000):
+    """time needed to capture the output of a block as the total output
+    of the script grows: it should not depend on the previous blocks
+    """
+    cage = OutputCage()
+    text = 'x' * (block_output - 1) + '\n'
+    timings = []
+    for _ in range(blocks):
+        cage.my_stdout.write(text)
+        start = time.perf_counter()
+        cage.get_stdout()
+        timings.append(time.perf_counter() - start)
+    tenth = max(blocks // 10, 1)
+    return {'total output (MB)': blocks * block_output / 1024**2,
+            'first blocks capture (us)': sum(timings[:tenth]) / tenth * 1e6,
+            'last blocks capture (us)': sum(timings[-tenth:]) / tenth * 1e6,
+            }
+
+
+def benchmark_block_overhead(blocks=20000):
+    """time added by the execution machinery to each block, a simple
+    assignment, with the output intercepted again for each block and with
+    a single session for all of them
+    """
+    source = "value = 1\n" * blocks
+    groups = list(CodeGroup.iterate_groups_from_source(
+        StringIO(source).readline))
+    code = str(groups[0])
+    start = time.perf_counter()
+    for group in groups:
+        exec(code, {})
+    exec_time = (time.perf_counter() - start) / blocks
+    measures = {'exec alone (us)': exec_time * 1e6}
+    for label in ['per block', 'session']:
+        cage, glob = OutputCage(), {}
+        start = time.perf_counter()
+        if label == 'session':
+            with cage.session():
+                for group in groups:
+                    group.execute(glob, cage)
+        else:
+            for group in groups:
+                group.execute(glob, cage)
+        elapsed = (time.perf_counter() - start) / blocks
+        measures['overhead, {} (us)'.format(label)] = (elapsed -
+                                                       exec_time) * 1e6
+    return measures
+
+
+def benchmark_figure_lifecycle(figures=400):
+    """latency of the show and memory used while a script creates many
+    figures without closing them, with and without the automatic closing.
+    the run closing the figures goes first, as the memory is measured as
+    increase of the peak of the process.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+    measures = {}
+    tenth = max(figures // 10, 1)
+    with tempfile.TemporaryDirectory() as output_dir:
+        for label, close_figures in [('closing', True), ('keeping', False)]:
+            cage = OutputCage(FigureSink(output_dir), close_figures)
+            timings = []
+            start_memory = _peak_memory()
+            with cage.session():
+                for idx in range(figures):
+                    figure = pyplot.figure(figsize=(2, 2), dpi=20)
+                    figure.gca().plot(range(1000))
+                    start = time.perf_counter()
+                    pyplot.show()
+                    timings.append(time.perf_counter() - start)
+                    cage.get_figures()
+            open_figures = len(pyplot.get_fignums())
+            pyplot.close('all')
+            measures[label + ' first shows (ms)'] = sum(timings[:tenth]) / \
+                tenth * 1e3
+            measures[label + ' last shows (ms)'] = sum(timings[-tenth:]) / \
+                tenth * 1e3
+            measures[label + ' open figures'] = open_figures
+            if start_memory is not None:
+                increase = _peak_memory() - start_memory
+                measures[label + ' memory increase (MB)'] = increase / 1024**2
+    return measures
+
+
+def benchmark_figure_encoding(figures=24, points=200000, workers=4):
+    """throughput of the figure rendering, serial against a pool of workers
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import pylab
+    measures = {'figures': figures, 'workers': workers}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for label, n_workers in [('serial', 0), ('parallel', workers)]:
+            encoder = FigureEncoder(n_workers) if n_workers else None
+            sink = FigureSink(output_dir, encoder)
+            if encoder is not None:
+                # start the workers before measuring
+                encoder.submit(pylab.figure(), output_dir, sink.options)
+                encoder.join()
+                pylab.close('all')
+            start = time.perf_counter()
+            for idx in range(figures):
+                figure = pylab.figure()
+                pylab.plot(range(points), [i % 97 for i in range(points)])
+                sink.write(figure, idx)
+                pylab.close(figure)
+            sink.close()
+            elapsed = time.perf_counter() - start
+            measures['{} (figures/s)'.format(label)] = figures / elapsed
+    return measures
+
+
+def generate_script(blocks=100, lines_per_block=3, docstring_ratio=0.25,
+                    output_bytes=0, figures=0, figure_points=1000, seed=0):
+    """a synthetic script to measure the compilation along several axes
+
+    the script has the given number of code blocks of lines_per_block
+    lines, alternating dictionaries, functions with a docstring and loops.
+    After each code block there is a text block with probability
+    docstring_ratio (one every ten with a section title). Each code block
+    is followed by a print of output_bytes characters, and figures of them,
+    evenly spaced, by the show of a figure with figure_points points.
+    """
+    import random
+    generator = random.Random(seed)
+    parts = ["import pylab\n"] if figures else []
+    figure_every = blocks // figures if figures else 0
+    text_blocks = 0
+    for idx in range(blocks):
+        kind = idx % 3
+        body = range(max(lines_per_block - 1, 1))
+        if kind == 0:
+            code = ("value_{} = {{\n".format(idx) +
+                    "".join("    'key_{0}': {0} * 2,  # a comment\n".format(j)
+                            for j in body) + "}\n")
+        elif kind == 1:
+            code = ('def function_{}(x):\n'
+                    '    """documentation of the function"""\n'.format(idx) +
+                    "".join("    x = x + {}\n".format(j) for j in body) +
+                    '    return x\n')
+        else:
+            code = ("for i in range(3):\n" +
+                    "".join("    value = i + {}\n".format(j) for j in body))
+        if output_bytes:
+            # lines of 80 characters, newline included
+            lines, rest = divmod(output_bytes, 80)
+            code += "print(({!r} * 79 + '\\n') * {} + 'x' * {})\n".format(
+                'x', lines, max(rest - 1, 0))
+        if figure_every and idx % figure_every == 0:
+            code += ("pylab.figure()\n"
+                     "pylab.plot(range({0}), range({0}))\n"
+                     "pylab.show()\n".format(figure_points))
+        parts.append(code)
+        if generator.random() < docstring_ratio:
+            title = ("Section {}\n----------------\n\n".format(idx)
+                     if text_blocks % 10 == 0 else "")
+            parts.append('"""\n{}some *text* about block {}, with a '
+                         '``literal``.\n"""\n'.format(title, idx))
+            text_blocks += 1
+    return "\n".join(parts)
+
+
+def benchmark_parse(sizes=(500, 2000, 8000)):
+    """throughput of the division of the source in groups, including the
+    source text and the docstrings of each one: it should not decrease
+    with the size of the script
+    """
+    measures = {}
+    for size in sizes:
+        source = generate_script(size, lines_per_block=5)
+        start = time.perf_counter()
+        groups = list(CodeGroup.iterate_groups_from_source(
+            StringIO(source).readline))
+        for group in groups:
+            str(group)
+            group.is_docstring()
+            group.extract_docstrings()
+            group.get_index()
+        elapsed = time.perf_counter() - start
+        lines = source.count('\n')
+        measures['{} blocks (klines/s)'.format(size)] = lines / elapsed / 1e3
+    return measures
+
+
+def benchmark_startup(repeats=3):
+    """time needed by a new process to compile a short script, with only
+    text and prints, and the same script importing pylab: as matplotlib is
+    imported only when used, the first should take less time
+    """
+    import subprocess
+    text = generate_script(5, docstring_ratio=1.0, output_bytes=100)
+    sources = {'text script': text, 'pylab script': "import pylab\n" + text}
+    measures = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, source in sources.items():
+            script = os.path.join(directory, 'script.py')
+            with open(script, 'wt') as file:
+                file.write(source)
+            command = [sys.executable, os.path.abspath(__file__), script]
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+                timings.append(time.perf_counter() - start)
+            measures['{} (s)'.format(name)] = min(timings)
+    measures['saving (s)'] = (measures['pylab script (s)'] -
+                              measures['text script (s)'])
+    return measures
+
+
+_PIPELINE_CONFIGURATIONS = {
+    'base': {},
+    'many blocks': {'blocks': 800},
+    'long blocks': {'lines_per_block': 30},
+    'much text': {'docstring_ratio': 1.0},
+    'much output': {'output_bytes': 20000},
+    'figures': {'figures': 8, 'figure_points': 20000},
+}
+
+
+def benchmark_pipeline(configurations=None, blocks=200):
+    """time of each stage of the compilation (parse, execute, compile and
+    render) on generated scripts, each configuration changing one of the
+    parameters of generate_script from the base one.
+
+    the times per block should not grow with the number of blocks: the
+    'block scaling' measure is the ratio of the execution time per group
+    of the 'many blocks' configuration to the 'base' one.
+    """
+    if configurations is None:
+        configurations = _PIPELINE_CONFIGURATIONS
+    measures = {}
+    per_block = {}
+    old_exit = sys.exit
+    # the first import of pylab should not be measured
+    import matplotlib
+    matplotlib.use('Agg')
+    import pylab
+    try:
+        for name, parameters in configurations.items():
+            parameters = dict({'blocks': blocks}, **parameters)
+            source = generate_script(**parameters)
+            with tempfile.TemporaryDirectory() as output_dir:
+                stages, groups = _time_pipeline(source, output_dir)
+            for stage, elapsed in stages.items():
+                measures['{} {} (ms)'.format(name, stage)] = elapsed * 1e3
+            per_block[name] = stages['execute'] / groups
+    finally:
+        sys.exit = old_exit
+    if 'base' in per_block and 'many blocks' in per_block:
+        measures['block scaling (ratio)'] = (per_block['many blocks'] /
+                                             per_block['base'])
+    return measures
+
+
+def _time_pipeline(source, output_dir):
+    """the time spent in each stage compiling the source, and the
+    number of groups"""
+    stages = {}
+    start = time.perf_counter()
+    groups = list(CodeGroup.iterate_groups_from_source(
+        StringIO(source).readline))
+    stages['parse'] = time.perf_counter() - start
+
+    cage = OutputCage(FigureSink(output_dir))
+    glob = cage.generate_globals(['script.py'])
+    start = time.perf_counter()
+    for group in groups:
+        group.execute(glob, cage)
+    cage.sink.close()
+    stages['execute'] = time.perf_counter() - start
+    import pylab
+    pylab.close('all')
+
+    start = time.perf_counter()
+    pieces = [group.compile(output_dir)[0] for group in groups]
+    stages['compile'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    render_html(pieces)
+    stages['render'] = time.perf_counter() - start
+    return stages, len(groups)
+
+
+def run_benchmarks(names=None, save=None, compare=None):
+    """run the benchmarks (all of them, or the given names), print and
+    return their measures.
+
+    the measures can be saved to a json file, and compared with the ones
+    of a file saved before (for example on another commit).
+    """
+    benchmarks = sorted((name, function) for name, function in
+                        globals().items() if name.startswith('benchmark_'))
+    measures = {}
+    for name, function in benchmarks:
+        if names and name not in names and name[10:] not in names:
+            continue
+        measures[name] = function()
+        print(name)
+        for key, value in measures[name].items():
+            print("    {}: {:.4g}".format(key, value))
+    if save:
+        data = {'python': sys.version, 'platform': sys.platform,
+                'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'benchmarks': measures}
+        with open(save, 'wt') as file:
+            json.dump(data, file, indent=1)
+    if compare:
+        with open(compare) as file:
+            reference = json.load(file)['benchmarks']
+        print(_format_benchmark_comparison(reference, measures))
+    return measures
+
+
+def _is_throughput(measure):
+    """the measures in units per second are better when higher"""
+    return '/s)' in measure
+
+
+def _compare_benchmarks(reference, measures, tolerance=0.2):
+    """the change of each measure present in both, as a list of
+    (benchmark, measure, old, new, relative change, is regression)
+    """
+    comparison = []
+    for name, values in measures.items():
+        for measure, new in values.items():
+            old = reference.get(name, {}).get(measure)
+            if not old:
+                continue
+            change = (new - old) / old
+            if measure == 'block scaling (ratio)':
+                # a scaling ratio should stay close to one
+                worse = new - old > tolerance
+            elif _is_throughput(measure):
+                worse = change < -tolerance
+            else:
+                worse = change > tolerance
+            comparison.append((name, measure, old, new, change, worse))
+    return comparison
+
+
+def _format_benchmark_comparison(reference, measures, tolerance=0.2):
+    lines = []
+    for name, measure, old, new, change, worse in _compare_benchmarks(
+            reference, measures, tolerance):
+        lines.append("{}{} {}: {:.4g} -> {:.4g} ({:+.0%})".format(
+            '!! ' if worse else '   ', name, measure, old, new, change))
+    regressions = sum(line.startswith('!!') for line in lines)
+    lines.append("{} measures compared, {} worse by more than {:.0%}"
+                 .format(len(lines), regressions, tolerance))
+    return "\n".join(lines)
+
+
 # %%
 """
 Tests
@@ -765,6 +4423,37 @@ class test_Group(unittest.TestCase):
         generated = "".join(str(g) for g in groups)
         self.assertEqual(generated, source_test_1)
 
+    def test_recomposition_after_indented_block(self):
+        code = ("def f(x):\n    return x\n\n\nprint(f(1))\n"
+                "if f:\n    a = 1\nb = 2\n")
+        groups = list(self.generate_groups(code))
+        self.assertEqual("".join(str(g) for g in groups), code)
+        self.assertEqual([g.get_index() for g in groups], [0, 1, 2, 3])
+        self.assertEqual([g.line_range for g in groups],
+                         [(1, 2), (3, 5), (6, 7), (8, 8)])
+        # the groups created directly from the tokens rebuild the source
+        rebuilt = [str(CodeGroup(g.tokens)).strip() for g in groups]
+        self.assertEqual(rebuilt, [str(g).strip() for g in groups])
+
+    def test_cells(self):
+        code = ("import os\na = 1\n"
+                "# %%\n\"\"\"text\"\"\"\nb = 2\nc = 3\n"
+                "# %% second cell\nprint(b + c)\nfor i in []:\n    pass\n")
+        origin = StringIO(code).readline
+        groups = list(CodeGroup.iterate_cells_from_source(origin))
+        self.assertEqual([str(g) for g in groups],
+                         ["import os\na = 1\n", "# %%\n\"\"\"text\"\"\"\n",
+                          "b = 2\nc = 3\n",
+                          "# %% second cell\nprint(b + c)\nfor i in []:\n"
+                          "    pass\n"])
+        self.assertEqual([bool(g.is_docstring()) for g in groups],
+                         [False, True, False, False])
+        self.assertEqual([g.get_index() for g in groups], [0, 1, 2, 3])
+        self.assertEqual(groups[3].line_range, (7, 10))
+        glob, cage = {}, OutputCage()
+        outputs = [g.execute(glob, cage)['standard output'] for g in groups]
+        self.assertEqual(outputs[3], '5\n')
+
     def test_simple_output(self):
         code = "print(1)\n"
         groups = self.generate_groups(code)
@@ -775,6 +4464,314 @@ class test_Group(unittest.TestCase):
         self.assertEqual(res['generated figures'], [])
         self.assertEqual(res['exceptions generated'], None)
 
+    def test_output_split_by_block(self):
+        code = "import sys\nout = sys.stdout\nprint(1)\nprint(2, file=out)\n"
+        groups = list(self.generate_groups(code))
+        glob, cage = {}, OutputCage()
+        outputs = [g.execute(glob, cage)['standard output'] for g in groups]
+        self.assertEqual(outputs, ['', '', '1\n', '2\n'])
+
+    def test_figure_sink(self):
+        code = ("import matplotlib\nmatplotlib.use('Agg')\nimport pylab\n"
+                "pylab.plot([1, 2])\npylab.show()\n")
+        groups = list(self.generate_groups(code))
+        with tempfile.TemporaryDirectory() as output_dir:
+            glob, cage = {}, OutputCage(FigureSink(output_dir))
+            for group in groups:
+                group.execute(glob, cage)
+            figures = groups[-1].results['generated figures']
+            f_path = os.path.join(output_dir, figures[0])
+            with open(f_path, 'rb') as file:
+                self.assertEqual(figures, [_figure_name(file.read())])
+            rst, figure_dict = groups[-1].compile(output_dir)
+            self.assertIn(figures[0], rst)
+            self.assertEqual(figure_dict, {})
+            # the same image is stored once, and not written again
+            mtime = os.stat(f_path).st_mtime_ns
+            os.utime(f_path, ns=(mtime - 10**9, mtime - 10**9))
+            again = list(self.generate_groups("pylab.gcf().show()\n"))[0]
+            again.execute(glob, cage)
+            self.assertEqual(again.results['generated figures'], figures)
+            self.assertEqual(len(os.listdir(output_dir)), 1)
+            self.assertEqual(os.stat(f_path).st_mtime_ns, mtime - 10**9)
+        import pylab
+        pylab.close('all')
+
+    def test_matplotlib_hook_removed(self):
+        def hooks():
+            return [finder for finder in sys.meta_path
+                    if isinstance(finder, _MatplotlibFinder)]
+        cage = OutputCage()
+        self.assertEqual(hooks(), [])
+        with cage.session():
+            self.assertEqual(len(hooks()), 1)
+            # a nested cage leaves the hook of the outer one in place
+            with OutputCage().session():
+                self.assertEqual(len(hooks()), 1)
+            self.assertEqual(len(hooks()), 1)
+        self.assertEqual(hooks(), [])
+
+    def test_figure_formats(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import pylab
+        figure = pylab.figure()
+        pylab.plot([1, 2])
+        try:
+            svg = _render_figure(figure, 'svg')
+            self.assertEqual(svg, _render_figure(figure, 'svg'))
+            self.assertTrue(svg.lstrip().startswith(b'<?xml'))
+            small = _render_figure(figure, dpi=20)
+            self.assertLess(len(small), len(_render_figure(figure, dpi=200)))
+            fast = _render_figure(figure, optimize=0)
+            self.assertGreater(len(fast), len(_render_figure(figure,
+                                                             optimize=9)))
+            with tempfile.TemporaryDirectory() as output_dir:
+                sink = FigureSink(output_dir, fmt='svg')
+                f_name = sink.write(figure, 0)
+                self.assertTrue(f_name.endswith('.svg'))
+        finally:
+            pylab.close(figure)
+
+    def test_figure_lifecycle(self):
+        import gc
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib import pyplot
+        pyplot.close('all')
+        code = ("from matplotlib import pyplot\n"
+                "for i in range(2):\n"
+                "    pyplot.figure()\n"
+                "    pyplot.show()\n"
+                "first = pyplot.figure()\n"
+                "second = pyplot.figure()\n"
+                "pyplot.figure(first.number)\n"
+                "pyplot.show()\n"
+                "is_current = pyplot.gcf() is first\n")
+        with tempfile.TemporaryDirectory() as output_dir:
+            for close_figures in [False, True]:
+                cage = OutputCage(FigureSink(output_dir), close_figures)
+                glob = {}
+                groups = list(self.generate_groups(code))
+                try:
+                    for group in groups:
+                        group.execute(glob, cage)
+                    # both the shows of the block are kept
+                    figures = groups[1].results['generated figures']
+                    self.assertEqual(len(figures), 2)
+                    # when closing, the figure activated after the show is
+                    # a new one, never shown
+                    self.assertEqual(len(pyplot.get_fignums()),
+                                     1 if close_figures else 4)
+                    # the show does not change the current figure
+                    self.assertEqual(glob['is_current'], not close_figures)
+                finally:
+                    pyplot.close('all')
+                del glob, groups, group
+                gc.collect()
+                self.assertEqual(len(cage.fig_index), 0)
+
+    def test_figure_encoder(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import pylab
+        figure = pylab.figure()
+        pylab.plot([1, 2])
+        with tempfile.TemporaryDirectory() as output_dir:
+            sink = FigureSink(output_dir, FigureEncoder(1))
+            pending = sink.write(figure, 3)
+            # the figure can change after it has been shown
+            figure.clear()
+            sink.close()
+            results = {"generated figures": [pending]}
+            self.assertTrue(sink.resolve(results))
+            f_name = results["generated figures"][0]
+            self.assertFalse(sink.resolve(results))
+            with open(os.path.join(output_dir, f_name), 'rb') as file:
+                encoded = file.read()
+            cleared = FigureSink(output_dir).write(figure, 4)
+        pylab.close(figure)
+        self.assertEqual(f_name, _figure_name(encoded))
+        self.assertNotEqual(f_name, cleared)
+
+    def test_encoded_figures_are_closed(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import pylab
+        figure = pylab.figure()
+        pylab.plot([1, 2])
+        payload = pickle.dumps(figure)
+        pylab.close(figure)
+        options = {'fmt': 'png', 'dpi': None, 'optimize': None}
+        with tempfile.TemporaryDirectory() as output_dir:
+            for _ in range(3):
+                _encode_figure(payload, output_dir, options)
+        self.assertEqual(pylab.get_fignums(), [])
+
+    def test_timings(self):
+        groups = list(self.generate_groups("print('abc')\n"))
+        usage = groups[0].execute({}, OutputCage())["resource usage"]
+        self.assertEqual(usage['standard output bytes'], 4)
+        self.assertGreaterEqual(usage['wall time'],
+                                usage['figure encode time'])
+        with tempfile.TemporaryDirectory() as output_dir:
+            write_outputs(groups, 'script.py', output_dir,
+                          phases={'parse': 0.0}, slowest_blocks=1)
+            with open(os.path.join(output_dir, 'timings.json')) as file:
+                timings = json.load(file)
+            with open(os.path.join(output_dir, 'script.html')) as file:
+                html = file.read()
+        self.assertEqual(sorted(timings['phases']),
+                         ['compile', 'parse', 'render', 'write'])
+        self.assertEqual(timings['blocks'][0]['lines'], [1, 1])
+        self.assertIn('Slowest blocks', html)
+
+    def test_profile(self):
+        code = ("def busy():\n    return sum(i * i for i in range(10**5))\n"
+                "a = busy()\nb = 1\n")
+        groups = list(self.generate_groups(code))
+        profiler = BlockProfiler(blocks=[1, 2], top=3, threshold=0.0)
+        cage, glob = OutputCage(), {}
+        for group in groups:
+            group.execute(glob, cage, profiler=profiler)
+        self.assertIsNone(groups[0].profile)
+        self.assertIsNotNone(groups[2].profile)
+        names = [function[0] for function in groups[1].profile['functions']]
+        self.assertEqual(len(names), 3)
+        self.assertTrue(any('busy' in name for name in names))
+        self.assertEqual(glob['a'], sum(i * i for i in range(10**5)))
+        self.assertIn('<details class="literate-profile">',
+                      groups[1].compile('.')[0])
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'script.pstats')
+            profiler.dump(path)
+            import pstats
+            self.assertTrue(pstats.Stats(path).total_calls > 0)
+
+    def test_profile_asyncio_block(self):
+        code = ("import asyncio\n"
+                "def busy():\n    return sum(i * i for i in range(10**5))\n"
+                "a = busy()  # not executed on the asyncio event loop\n")
+        groups = list(self.generate_groups(code))
+        profiler = BlockProfiler(blocks=[2], top=5, threshold=0.0)
+        cage, glob = OutputCage(), {}
+        for group in groups:
+            group.execute(glob, cage, profiler=profiler)
+        self.assertIsNone(cage.event_loop)
+        names = [function[0] for function in groups[2].profile['functions']]
+        self.assertTrue(any('busy' in name for name in names), names)
+
+    def test_memory(self):
+        code = "data = [0] * 10**6\nsmall = 1\nprint(len(data))\n"
+        groups = list(self.generate_groups(code))
+        tracer = MemoryTracer(top=2, threshold=10**6)
+        cage, glob = OutputCage(), {}
+        for group in groups:
+            group.execute(glob, cage, profiler=tracer)
+        tracer.close()
+        self.assertEqual(glob['small'], 1)
+        self.assertEqual([record['index'] for record in tracer.records],
+                         [0, 1, 2])
+        memory = groups[0].memory
+        self.assertGreaterEqual(memory['net bytes'], 8 * 10**6)
+        self.assertEqual(memory['globals'][0]['name'], 'data')
+        self.assertEqual(memory['sites'][0]['site'], 'line 1')
+        self.assertIsNone(groups[1].memory)
+        self.assertIn('literate-memory', groups[0].compile('.')[0])
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'memory.json')
+            tracer.dump(path)
+            with open(path) as file:
+                self.assertEqual(len(json.load(file)), 3)
+
+    def test_top_level_await(self):
+        code = ("import asyncio, sys\n"
+                "async def later(value):\n"
+                "    await asyncio.sleep(0.05)\n"
+                "    return value\n"
+                "task = asyncio.create_task(later(2)); await later(0)\n"
+                "x = await asyncio.sleep(0, result=1)\n"
+                "print(x + await task)\n"
+                "pending = asyncio.ensure_future(later(3)); await later(0)\n"
+                "sys.exit(await later(0))\n"
+                "print('not executed')\n"
+                "print(asyncio.run(later(4)))\n")
+        groups = list(self.generate_groups(code))
+        cage, glob = OutputCage(), {}
+        try:
+            with cage.session():
+                results = [group.execute(glob, cage) for group in groups]
+            self.assertEqual(cage.drain_tasks(), [])
+        finally:
+            cage.close_event_loop()
+        self.assertEqual(results[4]['standard output'], '3\n')
+        self.assertTrue(results[6]['interrupted'])
+        self.assertEqual(glob['pending'].result(), 3)
+        self.assertIsNone(cage.event_loop)
+        # without top-level await the blocks run on the main thread
+        self.assertFalse(_uses_event_loop("asyncio.run(main())  # asyncio\n"))
+        results = groups[8].execute(glob, OutputCage())
+        self.assertEqual(results['standard output'], '4\n')
+
+    def test_bounded_output(self):
+        code = ("for i in range(1000):\n    print(i)\n"
+                "print('short', end='')\n")
+        groups = list(self.generate_groups(code))
+        with tempfile.TemporaryDirectory() as output_dir:
+            cage = OutputCage(FigureSink(output_dir), output_lines=3)
+            results = [group.execute({}, cage) for group in groups]
+            f_name = results[0]['output files']['standard output']
+            with open(os.path.join(output_dir, f_name)) as file:
+                whole = file.read()
+            rst = groups[0].compile(output_dir)[0]
+        self.assertEqual(whole, "".join("{}\n".format(i)
+                                        for i in range(1000)))
+        lines = results[0]['standard output'].splitlines()
+        self.assertEqual(lines[:3], ['0', '1', '2'])
+        self.assertEqual(lines[-3:], ['997', '998', '999'])
+        self.assertIn('994 lines omitted', lines[3])
+        self.assertEqual(len(whole),
+                         results[0]['resource usage']['standard output bytes'])
+        self.assertIn('<./{}>`_'.format(f_name), rst)
+        self.assertEqual(results[1]['standard output'], 'short')
+        self.assertEqual(results[1]['output files'], {})
+        cage = OutputCage(output_lines=3)
+        output = groups[0].execute({}, cage)['standard output']
+        self.assertEqual(len(output.splitlines()), 7)
+
+    def test_matplotlib_imported_lazily(self):
+        import subprocess
+        code = ("import io, sys\n"
+                "import literate\n"
+                "cage = literate.OutputCage()\n"
+                "glob = cage.generate_globals(['script.py'])\n"
+                "source = io.StringIO('print(1)\\n').readline\n"
+                "for group in literate.CodeGroup.iterate_groups_from_source("
+                "source):\n"
+                "    group.execute(glob, cage)\n"
+                "print('matplotlib' in sys.modules)\n")
+        directory = os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.run([sys.executable, '-c', code], cwd=directory,
+                                stdout=subprocess.PIPE, check=True).stdout
+        self.assertEqual(output.strip(), b'False')
+
+    def test_session(self):
+        code = "print(1)\nimport sys\nsys.stdout = None\nprint(2)\n"
+        groups = list(self.generate_groups(code))
+        stdout = sys.stdout
+        cage, glob = OutputCage(), {}
+        with cage.session():
+            outputs = [g.execute(glob, cage)['standard output']
+                       for g in groups]
+        self.assertEqual(outputs, ['1\n', '', '', '2\n'])
+        self.assertIs(sys.stdout, stdout)
+        group = list(self.generate_groups("1/0\n"))[0]
+        with self.assertRaises(ZeroDivisionError):
+            with cage.session():
+                group.execute(glob, cage)
+        self.assertIs(sys.stdout, stdout)
+        self.assertIsNone(OutputCage.active)
+
     def test_simple_exception(self):
         code = "raise ValueError('error')\n"
         groups = self.generate_groups(code)
@@ -841,12 +4838,684 @@ class test_Group(unittest.TestCase):
         self.assertEqual(obtained, expected)
 
 
+# %%
+class test_Cache(unittest.TestCase):
+
+    def generate_groups(self, source_code):
+        origin = StringIO(source_code).readline
+        return list(CodeGroup.iterate_groups_from_source(origin))
+
+    def test_docstring_does_not_invalidate(self):
+        source = "a = 1\n'''text'''\nb = 2\n"
+        edited = "a = 1\n'''other text'''\nb = 2\n"
+        keys = _chain_cache_keys(self.generate_groups(source), ['x'])
+        keys_edited = _chain_cache_keys(self.generate_groups(edited), ['x'])
+        self.assertEqual(keys, keys_edited)
+        self.assertIsNone(keys[1])
+
+    def test_code_change_invalidates_following(self):
+        source = "a = 1\nb = 2\nc = 3\n"
+        edited = "a = 1\nb = 5\nc = 3\n"
+        keys = _chain_cache_keys(self.generate_groups(source), ['x'])
+        keys_edited = _chain_cache_keys(self.generate_groups(edited), ['x'])
+        self.assertEqual(keys[0], keys_edited[0])
+        self.assertNotEqual(keys[1], keys_edited[1])
+        self.assertNotEqual(keys[2], keys_edited[2])
+        keys_argv = _chain_cache_keys(self.generate_groups(source), ['y'])
+        self.assertNotEqual(keys[0], keys_argv[0])
+        keys_svg = _chain_cache_keys(self.generate_groups(source), ['x'],
+                                     {'fmt': 'svg'})
+        self.assertNotEqual(keys[0], keys_svg[0])
+        keys_lines = _chain_cache_keys(self.generate_groups(source), ['x'],
+                                       {'fmt': 'svg', 'output_lines': 2})
+        self.assertNotEqual(keys_svg[0], keys_lines[0])
+
+    def test_cached_results_are_not_executed(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResultCache(cache_dir)
+            group0 = self.generate_groups("print(1)\n")[0]
+            _chain_cache_keys([group0], [])
+            group0.execute({}, OutputCage(), cache)
+            glob = {}
+            res = group0.execute(glob, OutputCage(), cache)
+            self.assertEqual(res['standard output'], '1\n')
+            self.assertNotIn('__builtins__', glob)
+
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResultCache(cache_dir, max_size=1)
+            cache.put('first', {'standard output': 'a'})
+            cache.put('second', {'standard output': 'b'})
+            self.assertNotIn('first', cache)
+            self.assertLessEqual(len(cache.sizes), 1)
+            # no temporary file is left behind
+            self.assertTrue(all(name.endswith('.pickle')
+                                for name in os.listdir(cache_dir)))
+
+
+class test_Render(unittest.TestCase):
+
+    def test_self_contained(self):
+        code = (".. code:: python\n\n    my_var_ = `x`_\n\n"
+                "::\n\n    T\n    ===\n")
+        self.assertTrue(_is_self_contained(code))
+        self.assertTrue(_is_self_contained("*text* with snake_case names\n"))
+        for piece in ["Title\n=====\n", "see `this`_\n", ".. contents::\n",
+                      "the :math:`x^2`\n", ".. _target:\n", "|sub|\n",
+                      "* item\n", "text\n\n(2) item\n  continued\n",
+                      "term\n    definition\n"]:
+            self.assertFalse(_is_self_contained(piece), piece)
+
+    def test_same_html_as_whole_document(self):
+        pieces = ["Title\n=====\n", ".. contents::\n", "some *text*\n",
+                  ".. code:: python\n\n    a = 1\n\n::\n\n    1\n",
+                  "Section\n-------\n", "more text, see Title_\n",
+                  "* first item\n", "* second item\n", "1. one\n",
+                  "2. two\n", "term\n    definition\n",
+                  "other term\n    definition\n"]
+        expected = publish_parts("\n".join(pieces), writer_name='html')
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResultCache(cache_dir)
+            html, report = render_html(pieces, cache)
+            self.assertEqual(html, expected['whole'])
+            self.assertEqual((report['fragments'], report['hits']), (2, 0))
+            html, report = render_html(pieces, cache)
+            self.assertEqual(html, expected['whole'])
+            self.assertEqual((report['fragments'], report['hits']), (2, 2))
+
+    def test_write_only_changed(self):
+        origin = StringIO('"""text"""\nprint(1)\n').readline
+        groups = list(CodeGroup.iterate_groups_from_source(origin))
+        groups[1].execute({}, OutputCage())
+        with tempfile.TemporaryDirectory() as output_dir:
+            for name in ['figure_0_0.png', 'figure_data.csv',
+                         'figure_{}.svg'.format('0a' * 10), 'figure_b.png']:
+                with open(os.path.join(output_dir, name), 'w') as file:
+                    file.write('old')
+            report = write_outputs(groups, 'script.py', output_dir)['write']
+            self.assertEqual((report['written files'], report['skipped files'],
+                              report['removed files']), (2, 0, 2))
+            self.assertEqual(sorted(os.listdir(output_dir)),
+                             ['figure_b.png', 'figure_data.csv',
+                              'script.html', 'script.rst', 'timings.json'])
+            rst_file = os.path.join(output_dir, 'script.rst')
+            os.utime(rst_file, ns=(0, 0))
+            report = write_outputs(groups, 'script.py', output_dir)['write']
+            self.assertEqual((report['written bytes'],
+                              report['skipped files']), (0, 2))
+            self.assertEqual(os.stat(rst_file).st_mtime_ns, 0)
+        self.assertIn('0 stale files', _format_write_report(report))
+
+    def test_spilled_output_written_only_if_changed(self):
+        origin = StringIO('for i in range(10):\n    print(i)\n').readline
+        groups = list(CodeGroup.iterate_groups_from_source(origin))
+        with tempfile.TemporaryDirectory() as output_dir:
+            spilled = os.path.join(output_dir, 'output_0_stdout.txt')
+            for written, skipped in [(3, 0), (0, 3)]:
+                cage = OutputCage(FigureSink(output_dir), output_lines=2)
+                groups[0].execute({}, cage)
+                report = write_outputs(groups, 'script.py', output_dir,
+                                       written=[cage.sink.write_report])
+                self.assertEqual((report['write']['written files'],
+                                  report['write']['skipped files']),
+                                 (written, skipped))
+                if not skipped:
+                    os.utime(spilled, ns=(0, 0))
+            self.assertEqual(os.stat(spilled).st_mtime_ns, 0)
+            self.assertEqual(sorted(os.listdir(output_dir)),
+                             ['output_0_stdout.txt', 'script.html',
+                              'script.rst', 'timings.json'])
+
+
+class test_Benchmark(unittest.TestCase):
+
+    def test_generate_script(self):
+        source = generate_script(6, lines_per_block=4, docstring_ratio=1.0,
+                                 output_bytes=100)
+        groups = list(CodeGroup.iterate_groups_from_source(
+            StringIO(source).readline))
+        # each block has its code, the print and the text
+        self.assertEqual(len(groups), 18)
+        self.assertEqual(sum(bool(g.is_docstring()) for g in groups), 6)
+        self.assertEqual(len(str(groups[0]).splitlines()), 5)
+
+    def test_compare(self):
+        reference = {'benchmark_a': {'x (ms)': 10.0, 'y (klines/s)': 10.0,
+                                     'z (ms)': 10.0}}
+        measures = {'benchmark_a': {'x (ms)': 15.0, 'y (klines/s)': 15.0,
+                                    'w (ms)': 1.0}}
+        comparison = _compare_benchmarks(reference, measures)
+        self.assertEqual([(c[1], c[-1]) for c in comparison],
+                         [('x (ms)', True), ('y (klines/s)', False)])
+
+
+class test_Checkpoint(unittest.TestCase):
+
+    def test_restore_modules_and_functions(self):
+        glob = {}
+        exec("import math\ndef f(x=2):\n    return math.sqrt(x)\ny = [1]",
+             glob)
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpointer = Checkpointer(checkpoint_dir, every=1)
+            report = checkpointer.save('key', glob, 0)
+            self.assertEqual(report['unpicklable'], {})
+            restored = {}
+            self.assertTrue(checkpointer.restore('key', restored))
+        self.assertEqual(restored['f'](), glob['f']())
+        self.assertIs(restored['f'].__globals__, restored)
+        self.assertEqual(restored['y'], [1])
+
+    def test_unpicklable_names_are_reported(self):
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            glob = {'a': 1}
+            with open(os.path.join(checkpoint_dir, 'f.txt'), 'w') as file:
+                glob['file'] = file
+                checkpointer = Checkpointer(checkpoint_dir, every=1)
+                report = checkpointer.save('key', glob, 3)
+            self.assertEqual(list(report['unpicklable']), ['file'])
+            self.assertFalse(checkpointer.restore('key', {}))
+            self.assertIn('file', _format_checkpoint_report(report))
+
+    def test_restore_script_classes(self):
+        glob = {'__name__': '__main__'}
+        exec("class A:\n    scale = 2\n    def __init__(self, x):\n"
+             "        self.x = x\n    def double(self):\n"
+             "        return self.x * self.scale\na = A(21)\nb = [a]\n",
+             glob)
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpointer = Checkpointer(checkpoint_dir, every=1)
+            report = checkpointer.save('key', glob, 0)
+            self.assertEqual(report['unpicklable'], {})
+            restored = {'__name__': '__main__'}
+            self.assertTrue(checkpointer.restore('key', restored))
+        self.assertIsInstance(restored['a'], restored['A'])
+        self.assertEqual(restored['a'].double(), 42)
+        self.assertIs(restored['b'][0], restored['a'])
+        self.assertEqual(restored['A'].__module__, '__main__')
+
+    def test_broken_checkpoint(self):
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpointer = Checkpointer(checkpoint_dir, every=1)
+            checkpointer.storage.put('key', {'payload': b'broken',
+                                             'unpicklable': {}})
+            restored = {}
+            with redirect_stderr(StringIO()) as stderr:
+                self.assertFalse(checkpointer.restore('key', restored))
+        self.assertEqual(restored, {})
+        self.assertIn("can't be restored", stderr.getvalue())
+
+
+class test_Parallel(unittest.TestCase):
+    source = ("a = 1\nb = a + 1\nc = a + 2\nd = b + c\nprint(d)\n"
+              "x = []\nx.append(d)\n")
+
+    def generate_groups(self, source_code):
+        origin = StringIO(source_code).readline
+        return list(CodeGroup.iterate_groups_from_source(origin))
+
+    def test_schedule(self):
+        dataflow = BlockDataflow(self.generate_groups(self.source))
+        self.assertEqual(dataflow.reads[3], {'b', 'c'})
+        self.assertEqual(dataflow.writes[3], {'d'})
+        self.assertIsNotNone(dataflow.barriers[6])
+        expected = [[0, 5], [1, 2], [3], [4], [6]]
+        self.assertEqual(dataflow.schedule(), expected)
+
+    def test_barriers(self):
+        sources = ["global a\n", "exec('a = 1')\n", "a.b = 1\n",
+                   "import random\nx = random.random()\n",
+                   "f = lambda: open('x')\ny = f()\n",
+                   "import numpy\nx = numpy.loadtxt('x')\n",
+                   "from os import remove\nremove('x')\n",
+                   "import urllib.request as r\nx = r.urlopen('x')\n",
+                   "class A:\n    pass\n",
+                   "class A:\n    pass\na = 1\nb = A()\n"]
+        for source in sources:
+            dataflow = BlockDataflow(self.generate_groups(source))
+            self.assertIsNotNone(dataflow.barriers[-1], source)
+        sources = ["import math\nx = math.sqrt(2)\n",
+                   "def f(n):\n    l = []\n    l.append(n)\n    return l\n"
+                   "y = f(2)\n"]
+        for source in sources:
+            dataflow = BlockDataflow(self.generate_groups(source))
+            self.assertIsNone(dataflow.barriers[-1], source)
+
+    def test_functions_modifying_arguments(self):
+        sources = ["def add(l):\n    l.append(1)\nx = []\nadd(x)\n",
+                   "def f(rows):\n    for row in rows:\n        row[0] = 1\n"
+                   "y = [[0]]\nf(y)\n",
+                   "g = lambda d: d.update(a=1)\nz = {}\ng(z)\n"]
+        for source in sources:
+            dataflow = BlockDataflow(self.generate_groups(source))
+            self.assertIsNotNone(dataflow.barriers[-1], source)
+        source = "def add(l):\n    l.append(1)\nx = []\nadd(x)\ny = 1\n"
+        groups = self.generate_groups(source)
+        glob = {}
+        execute_parallel(groups, glob, OutputCage(), jobs=2)
+        self.assertEqual(glob['x'], [1])
+
+    def test_execute_parallel(self):
+        groups = self.generate_groups(self.source)
+        glob = {}
+        execute_parallel(groups, glob, OutputCage(), jobs=2)
+        self.assertEqual(glob['d'], 5)
+        self.assertEqual(glob['x'], [5])
+        self.assertEqual(groups[4].results['standard output'], '5\n')
+
+    def test_top_level_await(self):
+        source = ("import asyncio\nasync def later(v):\n    return v\n"
+                  "t = asyncio.ensure_future(later(3)); "
+                  "await asyncio.sleep(0)\nx = await t\ny = 2\n"
+                  "z = await later(4)\n")
+        groups = self.generate_groups(source)
+        self.assertIsNotNone(BlockDataflow(groups).barriers[-1])
+        cage = OutputCage()
+        glob = {}
+        try:
+            with cage.session():
+                execute_parallel(groups, glob, cage, jobs=2)
+        finally:
+            cage.close_event_loop()
+        self.assertEqual((glob['x'], glob['y'], glob['z']), (3, 2, 4))
+
+    def test_aliases(self):
+        source = "a = []\nb = 1\nc = a\nd = [a, a]\n"
+        groups = self.generate_groups(source)
+        glob = {}
+        execute_parallel(groups, glob, OutputCage(), jobs=2)
+        self.assertIs(glob['c'], glob['a'])
+        self.assertIs(glob['d'][0], glob['a'])
+
+    def test_script_classes(self):
+        # the instances can't be sent back from a worker, so the blocks
+        # using the class are executed in the main process
+        source = "class A:\n    pass\na = A()\nb = 1\nc = A()\nd = 2\n"
+        groups = self.generate_groups(source)
+        glob = {'__name__': '__main__'}
+        execute_parallel(groups, glob, OutputCage(), jobs=2)
+        self.assertIsInstance(glob['a'], glob['A'])
+        self.assertIsInstance(glob['c'], glob['A'])
+        self.assertEqual(glob['d'], 2)
+
+    def test_options(self):
+        with self.assertRaises(ValueError):
+            run_file('script.py', '.', ['script.py'], parallel_jobs=2,
+                     profile=[])
+        _check_parallel_options(parallel_jobs=2, output_lines=10,
+                                close_figures=True)
+
+    def test_output_lines(self):
+        source = "a = 1\nb = 2\nfor i in range(10):\n    print(i)\n"
+        groups = self.generate_groups(source)
+        with tempfile.TemporaryDirectory() as output_dir:
+            cage = OutputCage(FigureSink(output_dir), output_lines=2)
+            with cage.session():
+                execute_parallel(groups, {}, cage, jobs=2)
+        output = groups[2].results['standard output']
+        self.assertTrue(output.startswith('0\n1\n'), output)
+        self.assertTrue(output.endswith('8\n9\n'), output)
+        self.assertNotIn('\n5\n', output)
+
+
+class test_Kernel(unittest.TestCase):
+
+    def setUp(self):
+        # generate_globals replaces sys.exit
+        self.exit = sys.exit
+
+    def tearDown(self):
+        sys.exit = self.exit
+
+    def test_limits(self):
+        code = ("a = 21\nprint(a * 2)\nimport time\ntime.sleep(10)\n"
+                "print('not executed')\n")
+        with tempfile.TemporaryDirectory() as output_dir:
+            input_file = os.path.join(output_dir, 'script.py')
+            with open(input_file, 'w') as file:
+                file.write(code)
+            groups = list(CodeGroup.iterate_groups_from_source(
+                StringIO(code).readline))
+            kernel = IsolatedKernel(groups, [input_file], output_dir,
+                                    timeout=0.5)
+            try:
+                self.assertFalse(kernel.execute(groups, 0)['interrupted'])
+                output = kernel.execute(groups, 1)['standard output']
+                self.assertEqual(output, '42\n')
+                kernel.execute(groups, 2)
+                results = kernel.execute(groups, 3)
+            finally:
+                kernel.close()
+            self.assertFalse(kernel.alive)
+            self.assertTrue(results['interrupted'])
+            self.assertIn('TimeoutError', results['exceptions generated'])
+
+            with open(input_file, 'w') as file:
+                file.write("'''allocate too much'''\n"
+                           "data = bytearray(2 * 1024**3)\n")
+            run_file(input_file, output_dir, [input_file], use_cache=False,
+                     memory_limit=1024**3)
+            with open(os.path.join(output_dir, 'script.rst')) as file:
+                self.assertIn('exceeded the memory limit', file.read())
+
+
+class test_Batch(unittest.TestCase):
+
+    def test_batch_summary(self):
+        scripts = {'good.py': "print('ok')\n",
+                   'bad.py': "raise ValueError('broken')\n",
+                   'slow.py': "import time\ntime.sleep(60)\n",
+                   }
+        with tempfile.TemporaryDirectory() as base_dir:
+            for name, source in scripts.items():
+                with open(os.path.join(base_dir, name), 'w') as file:
+                    file.write(source)
+            summaries = run_batch([base_dir], jobs=2, timeout=2)
+            compiled = os.path.join(base_dir, 'compiled_good.py', 'good.html')
+            self.assertTrue(os.path.exists(compiled))
+        errors = {os.path.basename(summary['script']): summary['error']
+                  for summary in summaries}
+        self.assertEqual(list(errors), ['bad.py', 'good.py', 'slow.py'])
+        self.assertIsNone(errors['good.py'])
+        self.assertIn('broken', errors['bad.py'])
+        self.assertIn('timed out', errors['slow.py'])
+        self.assertIn('1 failed', _format_batch_summary(summaries[1:]))
+
+    def test_scripts_are_isolated(self):
+        scripts = {'a.py': "import json\njson.leaked = True\n",
+                   'b.py': "import json\nprint(hasattr(json, 'leaked'))\n"}
+        with tempfile.TemporaryDirectory() as base_dir:
+            for name, source in scripts.items():
+                with open(os.path.join(base_dir, name), 'w') as file:
+                    file.write(source)
+            run_batch([base_dir], jobs=1, preload=('json',),
+                      use_cache=False)
+            rst_file = os.path.join(base_dir, 'compiled_b.py', 'b.rst')
+            with open(rst_file) as file:
+                self.assertIn('    False', file.read())
+
+    def test_options_starting_processes(self):
+        # the compilations can start processes of their own
+        with tempfile.TemporaryDirectory() as base_dir:
+            with open(os.path.join(base_dir, 'script.py'), 'w') as file:
+                file.write("a = 1\nb = 2\nprint(a + b)\n")
+            for options in [{'figure_workers': 2, 'parallel_jobs': 2},
+                            {'isolate': True}]:
+                summaries = run_batch([base_dir], jobs=1, preload=(),
+                                      **options)
+                self.assertIsNone(summaries[0]['error'], options)
+
+
+class test_Server(unittest.TestCase):
+
+    def test_compile_on_server(self):
+        import multiprocessing
+        with tempfile.TemporaryDirectory() as base_dir:
+            socket_path = os.path.join(base_dir, 'literate.sock')
+            input_file = os.path.join(base_dir, 'script.py')
+            with open(input_file, 'w') as file:
+                file.write("import sys\nprint('argument', sys.argv[1])\n")
+            context = multiprocessing.get_context('fork')
+            server = context.Process(target=serve, daemon=True,
+                                     args=(socket_path, ('docutils.core',), 1))
+            server.start()
+            try:
+                while not os.path.exists(socket_path):
+                    time.sleep(0.01)
+                output_dir = os.path.join(base_dir, 'compiled')
+                summary = compile_on_server(socket_path, input_file,
+                                            output_dir, [input_file, 'x'],
+                                            use_cache=False)
+                server.join(5)
+            finally:
+                server.kill()
+            self.assertIsNone(summary['error'])
+            self.assertEqual(summary['script'], input_file)
+            self.assertFalse(os.path.exists(socket_path))
+            with open(os.path.join(output_dir, 'script.rst')) as file:
+                self.assertIn('argument x', file.read())
+
+
+class test_Sweep(unittest.TestCase):
+
+    def setUp(self):
+        # generate_globals replaces sys.exit
+        self.exit = sys.exit
+
+    def tearDown(self):
+        sys.exit = self.exit
+
+    def test_reads_argv(self):
+        def group(source):
+            origin = StringIO(source).readline
+            return next(CodeGroup.iterate_groups_from_source(origin))
+        self.assertTrue(_reads_argv(group("n = int(sys.argv[1])\n")))
+        self.assertTrue(_reads_argv(group("from sys import argv\n")))
+        self.assertTrue(_reads_argv(group("args = parser.parse_args()\n")))
+        self.assertFalse(_reads_argv(group("import numpy as np\n")))
+        self.assertFalse(_reads_argv(group('"the argv"\n')))
+
+    def test_sweep_shares_prefix(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            input_file = os.path.join(base_dir, 'script.py')
+            setup_log = os.path.join(base_dir, 'setup.log')
+            with open(input_file, 'w') as file:
+                file.write("import sys\n"
+                           "'''the setup is executed once'''\n"
+                           "with open({!r}, 'a') as log:\n"
+                           "    log.write('setup')\n"
+                           "hidden = __import__('sys').__dict__['ar' + 'gv']\n"
+                           "n = int(hidden[1])\n"
+                           "print('result', n * 21)\n".format(setup_log))
+            output_dir = os.path.join(base_dir, 'sweep')
+            old_argv = sys.argv
+            summaries = run_sweep(input_file, [['1'], ['2'], ['x']],
+                                  output_dir, jobs=2)
+            self.assertIs(sys.argv, old_argv)
+            with open(setup_log) as file:
+                self.assertEqual(file.read(), 'setup')
+            self.assertEqual([summary['argv'] for summary in summaries],
+                             [['1'], ['2'], ['x']])
+            self.assertIsNone(summaries[0]['error'])
+            self.assertIn('ValueError', summaries[2]['error'])
+            for summary, expected in zip(summaries[:2], ['21', '42']):
+                rst_file = os.path.join(summary['output_dir'], 'script.rst')
+                with open(rst_file) as file:
+                    self.assertIn('result ' + expected, file.read())
+            with open(os.path.join(output_dir, 'index.html')) as file:
+                index = file.read()
+        self.assertIn('000_1/script.html', index)
+        self.assertNotIn('002_x/script.html', index)
+        self.assertIn('2 failed', _format_sweep_summary(summaries * 2))
+
+    def test_sweep_options(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            input_file = os.path.join(base_dir, 'script.py')
+            with open(input_file, 'w') as file:
+                file.write("import pylab\n"
+                           "for i in range(10):\n    print('shared', i)\n"
+                           "pylab.plot([1, 2])\npylab.show()\n"
+                           "import sys\n"
+                           "for i in range(10):\n    print(sys.argv[1], i)\n")
+            output_dir = os.path.join(base_dir, 'sweep')
+            summaries = run_sweep(input_file, [['a'], ['b']], output_dir,
+                                  jobs=2, output_lines=2, figure_format='svg')
+            for summary in summaries:
+                self.assertIsNone(summary['error'])
+                names = os.listdir(summary['output_dir'])
+                self.assertEqual(len([name for name in names
+                                      if name.endswith('.svg')]), 1)
+                self.assertEqual(len([name for name in names
+                                      if name.startswith('output_')]), 2)
+                rst_file = os.path.join(summary['output_dir'], 'script.rst')
+                with open(rst_file) as file:
+                    rst = file.read()
+                self.assertNotIn('shared 5', rst)
+                self.assertNotIn(summary['argv'][0] + ' 5', rst)
+
+
+class test_Watcher(unittest.TestCase):
+
+    def setUp(self):
+        # generate_globals replaces sys.exit
+        self.exit = sys.exit
+
+    def tearDown(self):
+        sys.exit = self.exit
+
+    def test_first_changed_group(self):
+        def groups(source):
+            origin = StringIO(source).readline
+            return list(CodeGroup.iterate_groups_from_source(origin))
+        old = groups("a = 1\n'''text'''\nb = 2\nc = 3\n")
+        new = groups("a = 1\n'''new text'''\nb = 2\nc = 4\n")
+        self.assertEqual(_first_changed_group(old, new), 3)
+        self.assertEqual(_first_changed_group(old, old), 4)
+        self.assertEqual(_first_changed_group([], new), 0)
+
+    def test_update_executes_from_changed_block(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            input_file = os.path.join(base_dir, 'script.py')
+            with open(input_file, 'w') as file:
+                file.write("runs = []\nruns.append(1)\nprint(len(runs))\n")
+            output_dir = os.path.join(base_dir, 'compiled')
+            watcher = Watcher(input_file, output_dir, [input_file])
+            self.assertEqual(watcher.update(), 3)
+            with open(input_file, 'w') as file:
+                file.write("runs = []\nruns.append(1)\nprint(len(runs)+1)\n")
+            self.assertEqual(watcher.update(), 1)
+            self.assertEqual(watcher.glob['runs'], [1])
+            output = watcher.groups[2].results['standard output']
+            self.assertEqual(output, '2\n')
+            self.assertTrue(os.path.exists(os.path.join(output_dir,
+                                                        'script.html')))
+
+
 # %%
 """
 Command Line Execution
 =======================
 """
 
+def _argument_parser():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='compile a python script into a rst and html report',
+        epilog='options of literate must come before the script name, '
+               'the arguments after it are passed to the script')
+    parser.add_argument('script', nargs='?', help='the script to compile')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                        help='arguments passed as argv to the script')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and recompile the script on save')
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='seconds between checks of the file in watch '
+                             'mode (default: %(default)s)')
+    parser.add_argument('--cache', dest='use_cache', action='store_true',
+                        help='reuse the results of the blocks unchanged since '
+                             'the last compilation (they are stale if the '
+                             'blocks read files or other changing data)')
+    parser.add_argument('--checkpoint-every', type=int, default=0,
+                        metavar='N',
+                        help='snapshot the globals every N blocks '
+                             '(implies --cache)')
+    parser.add_argument('--figure-workers', type=int, default=0, metavar='N',
+                        help='render the figures in N worker processes')
+    parser.add_argument('--figure-format', default='png',
+                        help='format of the figures, like png, svg or webp '
+                             '(default: %(default)s)')
+    parser.add_argument('--figure-dpi', type=float, default=None,
+                        help='resolution of the figures (default: the one '
+                             'of each figure)')
+    parser.add_argument('--figure-optimize', type=int, default=None,
+                        metavar='LEVEL',
+                        help='compression effort of the figures: 0-9 for '
+                             'png, 0-6 for webp')
+    parser.add_argument('--parallel-blocks', type=int, default=0,
+                        metavar='N',
+                        help='execute the independent blocks together in N '
+                             'worker processes')
+    parser.add_argument('--cells', action='store_true',
+                        help='execute and show together the code of each '
+                             'cell, delimited by "# %%%%" comments')
+    parser.add_argument('--close-figures', action='store_true',
+                        help='close the figures once shown, to release '
+                             'their memory')
+    parser.add_argument('--slowest-blocks', type=int, default=0, metavar='N',
+                        help='add to the html a table of the N slowest '
+                             'blocks')
+    parser.add_argument('--profile', action='store_true',
+                        help='execute the blocks under cProfile, saving the '
+                             'statistics and showing the slowest functions')
+    parser.add_argument('--profile-blocks', nargs='+', type=int,
+                        metavar='BLOCK',
+                        help='profile only the blocks with these indices')
+    parser.add_argument('--profile-top', type=int, default=10, metavar='N',
+                        help='number of functions shown for each profiled '
+                             'block (default: %(default)s)')
+    parser.add_argument('--profile-threshold', type=float, default=0.1,
+                        metavar='SECONDS',
+                        help='show the functions only for the blocks slower '
+                             'than this (default: %(default)s)')
+    parser.add_argument('--memory', action='store_true',
+                        help='trace the memory allocated by each block, '
+                             'writing it in memory.json and in the report')
+    parser.add_argument('--memory-top', type=int, default=5, metavar='N',
+                        help='number of allocation sites and globals shown '
+                             'for each block (default: %(default)s)')
+    parser.add_argument('--memory-threshold', type=float, default=1.0,
+                        metavar='MB',
+                        help='annotate only the blocks leaving allocated '
+                             'more than this (default: %(default)s)')
+    parser.add_argument('--output-lines', type=int, default=None,
+                        metavar='N',
+                        help='show only the first and last N lines of the '
+                             'output of each block, writing the whole output '
+                             'to a text file')
+    parser.add_argument('--isolate', action='store_true',
+                        help='execute the blocks in a separate process, '
+                             'so that the limits can be enforced')
+    parser.add_argument('--block-timeout', type=float, default=None,
+                        metavar='SECONDS',
+                        help='interrupt a block running longer than this '
+                             '(implies --isolate)')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        metavar='MB',
+                        help='maximum address space of the process '
+                             'executing the blocks (implies --isolate)')
+    parser.add_argument('--batch', nargs='+', metavar='PATH',
+                        help='compile all the scripts in the given files and '
+                             'directories in a pool of processes')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of processes for --batch and --sweep '
+                             '(default: one per CPU)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        metavar='SECONDS',
+                        help='maximum time for each script in --batch '
+                             'and --connect')
+    parser.add_argument('--sweep', metavar='FILE',
+                        help='compile the script once for each line of FILE, '
+                             'read as further arguments of the script')
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='start a fork server on the Unix socket, '
+                             'compiling the scripts sent with --connect')
+    parser.add_argument('--preload', nargs='+', metavar='MODULE',
+                        default=list(_DEFAULT_PRELOAD),
+                        help='modules imported once by --serve and --batch '
+                             '(default: %(default)s)')
+    parser.add_argument('--connect', metavar='SOCKET',
+                        help='compile the script on the fork server '
+                             'listening on the Unix socket')
+    parser.add_argument('--benchmark', nargs='*', metavar='NAME',
+                        help='run the benchmarks (all if no name is given) '
+                             'instead of compiling a script')
+    parser.add_argument('--benchmark-save', metavar='FILE',
+                        help='save the measures of the benchmarks as json')
+    parser.add_argument('--benchmark-compare', metavar='FILE',
+                        help='compare the measures of the benchmarks with '
+                             'the ones saved in a json file')
+    return parser
+
+
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         print('running it with empty arguments runs the tests')
@@ -854,13 +5523,82 @@ if __name__ == '__main__':
         print('other arguments are passed as argv to the script')
         unittest.main()
     else:
-        input_file = sys.argv[1]
-        input_file = os.path.normpath(input_file)
-        base_dir = os.path.dirname(input_file)
-        filename = os.path.basename(input_file)
-        output_dir = os.path.join(base_dir, 'compiled_{}'.format(filename))
-        output_dir = os.path.normpath(output_dir)
-        print(input_file, output_dir, sys.argv[2:])
-        total_path_in = os.path.join(base_dir, input_file)
-        argv = [os.path.abspath(total_path_in)] + sys.argv[2:]
-        run_file(os.path.abspath(total_path_in), output_dir, argv)
+        parser = _argument_parser()
+        args = parser.parse_args()
+        if args.benchmark is not None:
+            run_benchmarks(args.benchmark, args.benchmark_save,
+                           args.benchmark_compare)
+            sys.exit(0)
+        memory_threshold = int(args.memory_threshold * 1024**2)
+        profile = args.profile_blocks or ([] if args.profile else None)
+        memory_limit = None
+        if args.memory_limit:
+            memory_limit = int(args.memory_limit * 1024**2)
+        if args.serve:
+            try:
+                serve(args.serve, args.preload)
+            except KeyboardInterrupt:
+                pass
+            sys.exit(0)
+        use_cache = args.use_cache or bool(args.checkpoint_every)
+        options = dict(use_cache=use_cache,
+                       checkpoint_every=args.checkpoint_every,
+                       figure_workers=args.figure_workers,
+                       parallel_jobs=args.parallel_blocks,
+                       slowest_blocks=args.slowest_blocks,
+                       close_figures=args.close_figures,
+                       cells=args.cells, profile=profile,
+                       profile_top=args.profile_top,
+                       profile_threshold=args.profile_threshold,
+                       memory=args.memory, memory_top=args.memory_top,
+                       memory_threshold=memory_threshold,
+                       isolate=args.isolate, block_timeout=args.block_timeout,
+                       memory_limit=memory_limit,
+                       output_lines=args.output_lines,
+                       figure_format=args.figure_format,
+                       figure_dpi=args.figure_dpi,
+                       figure_optimize=args.figure_optimize)
+        try:
+            _check_parallel_options(**options)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.batch:
+            summaries = run_batch(args.batch, args.jobs, args.timeout,
+                                  args.preload, **options)
+            print(_format_batch_summary(summaries))
+            raise SystemExit(any(summary['error'] for summary in summaries))
+        if args.script is None:
+            parser.error('the script to compile is required')
+        input_file = os.path.abspath(os.path.normpath(args.script))
+        output_dir = _default_output_dir(os.path.normpath(args.script))
+        print(args.script, output_dir, args.script_args)
+        argv = [input_file] + args.script_args
+        if args.sweep:
+            argv_sets = [args.script_args + argv_set
+                         for argv_set in _read_argv_sets(args.sweep)]
+            summaries = run_sweep(input_file, argv_sets, jobs=args.jobs,
+                                  slowest_blocks=args.slowest_blocks,
+                                  close_figures=args.close_figures,
+                                  cells=args.cells,
+                                  output_lines=args.output_lines,
+                                  figure_format=args.figure_format,
+                                  figure_dpi=args.figure_dpi,
+                                  figure_optimize=args.figure_optimize)
+            print(_format_sweep_summary(summaries))
+            raise SystemExit(any(summary['error'] for summary in summaries))
+        if args.connect:
+            summary = compile_on_server(args.connect, input_file, output_dir,
+                                        argv, args.timeout, **options)
+            if summary['error']:
+                print(summary['error'], file=sys.stderr)
+            raise SystemExit(bool(summary['error']))
+        if args.watch:
+            watcher = Watcher(input_file, output_dir, argv,
+                              args.slowest_blocks, args.close_figures,
+                              args.cells, args.output_lines,
+                              {'fmt': args.figure_format,
+                               'dpi': args.figure_dpi,
+                               'optimize': args.figure_optimize})
+            watcher.watch(args.interval)
+        else:
+            run_file(input_file, output_dir, argv, **options)